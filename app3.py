@@ -1,6 +1,10 @@
-import httpx
+import io
+import os
+import hashlib
 import argparse
 from langchain_core.language_models import BaseChatModel
+import httpcache
+from httpcache import fetch_text
 
 parser = argparse.ArgumentParser(
   description="""
@@ -12,8 +16,15 @@ parser = argparse.ArgumentParser(
 
 parser.add_argument("-p", "--provider", required = True, 
                     help = "provider to use. It can be mistral or google or the pulled ollama model")
+parser.add_argument("-c", "--compact", action = "store_true",
+                    help = "send a compact, deduplicated rendering of the resources instead of the whole CSV")
+parser.add_argument("--context-tokens", type = int, default = 4000,
+                    help = "token budget of the compact rendering of the resources")
+parser.add_argument("--offline", action = "store_true",
+                    help = "do not download the resources CSV, use the last downloaded copy")
 
 args = parser.parse_args()
+httpcache.offline = httpcache.offline or args.offline
 
 def load_chat_model(model: str) -> BaseChatModel:
   provider, model_name = model.split("/", maxsplit=1)
@@ -39,24 +50,61 @@ def load_chat_model(model: str) -> BaseChatModel:
     # https://python.langchain.com/docs/integrations/chat/ollama/
     from langchain_ollama import ChatOllama
     return ChatOllama(model=model_name, temperature=0)
+  elif provider == "fake":
+    # Local stand-in answering at a fixed rate, to run offline (see bench.py e2e)
+    from fakellm import FakeChatModel
+    return FakeChatModel()
 
 
 SYSTEM_PROMPT = """You are an assistant that helps users to navigate the resources and databases from the SIB Swiss Institute of Bioinformatics. Here is the description of resources available at the SIB: {context} Use it to answer the question"""
 
-response = httpx.get(
-  "https://github.com/sib-swiss/sparql-llm/raw/refs/heads/main/src/expasy-agent/expasy_resources_metadata.csv", 
-  follow_redirects=True
+# Downloaded again only when it changed upstream, and served from the cache when GitHub is unreachable
+resources_csv = fetch_text(
+  "https://github.com/sib-swiss/sparql-llm/raw/refs/heads/main/src/expasy-agent/expasy_resources_metadata.csv"
 )
 
+def compact_context(csv: str, max_tokens: int) -> str:
+  """Render the title, url, category and first sentence of the description of each resource,
+  without duplicates, within `max_tokens` (~4 characters per token). Cached on disk."""
+  digest = hashlib.sha256(f"{max_tokens}:{csv}".encode()).hexdigest()[:16]
+  cache_path = f"data/resources-context-{digest}.md"
+  if os.path.exists(cache_path):
+    with open(cache_path) as f:
+      return f.read()
+  import pandas as pd
+  df = pd.read_csv(io.StringIO(csv), usecols=["title", "url", "category", "description"])
+  df = df.drop_duplicates(subset=["title", "url"]).fillna("")
+  lines: list[str] = []
+  chars = 0
+  for title, url, category, description in df.itertuples(index=False):
+    short = " ".join(str(description).split(". ")[0].split()[:30])
+    line = f"- [{title}]({url}) ({category}): {short}"
+    chars += len(line) + 1
+    if chars > max_tokens * 4:
+      break
+    lines.append(line)
+  context = "\n".join(lines)
+  os.makedirs("data", exist_ok=True)
+  with open(cache_path, "w") as f:
+    f.write(context)
+  return context
+
+# Format the system prompt once: an identical prefix in every call lets providers that support it cache the prompt
+context = compact_context(resources_csv, args.context_tokens) if args.compact else resources_csv
+system_prompt = SYSTEM_PROMPT.format(context=context)
+print(f"📄 Resources context: {len(context)} characters ({len(resources_csv)} in the CSV)")
+
 def ask(question: str) -> str:
   messages = [
-    ("system", SYSTEM_PROMPT.format(context=response.text)),
+    ("system", system_prompt),
     ("human", question),
   ]
   for resp in llm.stream(messages):
     print(resp.content, end="")
     if resp.usage_metadata:
       print(f"\n\n{resp.usage_metadata}")
+      cached = resp.usage_metadata.get("input_token_details", {}).get("cache_read", 0)
+      print(f"📉 {resp.usage_metadata['input_tokens']} input tokens ({cached} read from the provider cache)")
 
 ## call
 if args.provider == "mistral":
@@ -65,6 +113,8 @@ elif args.provider == "google":
   llm = load_chat_model("google/gemini-2.0-flash")
 elif args.provider == "olama":
   llm = load_chat_model("ollama/mistral")
+elif args.provider == "fake":
+  llm = load_chat_model("fake/fake")
 else:
   raise ValueError(f"Unknown provider: {args.provider}")
 
@@ -1,6 +1,11 @@
+import asyncio
 import argparse
 from langchain_core.language_models import BaseChatModel
-from index import vectordb, embedding_model, collection_name
+from index import embed_questions
+from retriever import get_retriever
+from tracing import span, traced
+from batch import read_questions, write_results, stage, result, print_summary
+from context import pack_context
 
 parser = argparse.ArgumentParser(
   description="""
@@ -12,8 +17,23 @@ parser = argparse.ArgumentParser(
 
 parser.add_argument("-p", "--provider", required = True, 
                     help = "provider to use. It can be mistral or google or the pulled ollama model")
+parser.add_argument("--candidates", type = int, default = 30,
+                    help = "number of documents retrieved from the vectordb before packing the context")
+parser.add_argument("--context-tokens", type = int, default = 3000,
+                    help = "token budget of the retrieved documents in the prompt")
 
+parser.add_argument("--hybrid", action = "store_true",
+                    help = "fuse the dense and BM25 searches, to better match identifiers like P68871 or TP53")
+parser.add_argument("--retriever", choices = ["qdrant", "numpy"], default = "qdrant",
+                    help = "search backend, numpy searches the flat export of the index in-process (dense search only)")
+parser.add_argument("--batch",
+                    help = "answer the questions of a JSONL file (- for stdin) instead of the examples, and write the results as JSONL")
+parser.add_argument("-o", "--output", default = "-",
+                    help = "JSONL file of the batch results (- for stdout)")
+parser.add_argument("--concurrency", type = int, default = 8,
+                    help = "maximum number of concurrent LLM calls in batch mode")
 args = parser.parse_args()
+retriever = get_retriever(args.retriever)
 
 def load_chat_model(model: str) -> BaseChatModel:
   provider, model_name = model.split("/", maxsplit=1)
@@ -39,29 +59,61 @@ def load_chat_model(model: str) -> BaseChatModel:
     # https://python.langchain.com/docs/integrations/chat/ollama/
     from langchain_ollama import ChatOllama
     return ChatOllama(model=model_name, temperature=0)
+  elif provider == "fake":
+    # Local stand-in answering at a fixed rate, to run offline (see bench.py e2e)
+    from fakellm import FakeChatModel
+    return FakeChatModel()
 
 SYSTEM_PROMPT = """You are an assistant that helps users to navigate the resources and databases from the SIB Swiss Institute of Bioinformatics. Here is the description of resources available at the SIB: {context} Use it to answer the question"""
 
+def format_description(payload: dict) -> str | None:
+  return f"\n{payload['description']}" if "description" in payload else None
+
+@traced("answer")
 def ask(question: str) -> str:
-  # Generate embeddings for the user question
-  question_embeddings = next(iter(embedding_model.embed([question])))
-  
-  # Find similar embeddings in the vector database
-  retrieved_docs = vectordb.query_points(
-    collection_name=collection_name,
-    query=question_embeddings,
-    limit=10,
-  )
-  print(f"📚️ Retrieved {len(retrieved_docs.points)} documents")
-  formatted_docs = '\n'.join(doc.payload["description"] for doc in retrieved_docs.points if "description" in doc.payload)
+  # Find the documents with embeddings similar to the user question in the vector database
+  points = retriever.search(question, limit=args.candidates, hybrid=args.hybrid)
+  formatted_docs, packed, tokens = pack_context(points, args.context_tokens, formatter=format_description)
+  print(f"📚️ Retrieved {len(points)} documents, {len(packed)} packed in the context ({tokens} tokens)")
   messages = [
     ("system", SYSTEM_PROMPT.format(context=formatted_docs)),
     ("human", question),
   ]
-  for resp in llm.stream(messages):
-    print(resp.content, end="")
-    if resp.usage_metadata:
-      print(f"\n\n{resp.usage_metadata}")
+  with span("generate") as current:
+    for resp in llm.stream(messages):
+      current.token()
+      print(resp.content, end="")
+      if resp.usage_metadata:
+        print(f"\n\n{resp.usage_metadata}")
+        current.set(input_tokens=resp.usage_metadata["input_tokens"], output_tokens=resp.usage_metadata["output_tokens"])
+
+async def ask_batch(items: list[dict]) -> list[dict]:
+  """Answer a batch of questions: one embedding call, one vectordb call and concurrent LLM calls."""
+  questions = [item["question"] for item in items]
+  timings: dict[str, float] = {}
+  with stage(timings, "embed"):
+    question_embeddings = embed_questions(questions)
+  with stage(timings, "search"):
+    results = retriever.search_batch(
+      [(question, None) for question in questions], args.candidates, args.hybrid, question_embeddings
+    )
+  with stage(timings, "pack"):
+    contexts = [pack_context(points, args.context_tokens, formatter=format_description) for points in results]
+  with stage(timings, "generate"):
+    responses = await llm.abatch(
+      [
+        [("system", SYSTEM_PROMPT.format(context=formatted_docs)), ("human", question)]
+        for question, (formatted_docs, _, _) in zip(questions, contexts)
+      ],
+      config={"max_concurrency": args.concurrency},
+      return_exceptions=True,
+    )
+  outputs = [
+    result(item, response, packed, tokens, timings, len(items))
+    for item, response, (_, packed, tokens) in zip(items, responses, contexts)
+  ]
+  print_summary(timings, outputs)
+  return outputs
 
 ## call
 if args.provider == "mistral":
@@ -70,10 +122,16 @@ elif args.provider == "google":
   llm = load_chat_model("google/gemini-2.0-flash")
 elif args.provider == "olama":
   llm = load_chat_model("ollama/mistral")
+elif args.provider == "fake":
+  llm = load_chat_model("fake/fake")
 else:
   raise ValueError(f"Unknown provider: {args.provider}")
 
-ask("Which is the best SIB tool for comparative genomics?")
-print("\n------\n")
-ask("Which resources should I use to study the evolution of a protein?")
+if args.batch:
+  # One event loop for the whole batch, the async clients of the providers are bound to it
+  write_results(asyncio.run(ask_batch(read_questions(args.batch))), args.output)
+else:
+  ask("Which is the best SIB tool for comparative genomics?")
+  print("\n------\n")
+  ask("Which resources should I use to study the evolution of a protein?")
 
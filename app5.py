@@ -1,6 +1,12 @@
+import asyncio
 import argparse
 from langchain_core.language_models import BaseChatModel
-from index import vectordb, embedding_model, collection_name
+from index import embed_question, embed_questions, index_version
+from retriever import get_retriever
+from tracing import span, traced
+from batch import read_questions, write_results, stage, result, print_summary
+from cache import SemanticCache
+from context import pack_context
 
 parser = argparse.ArgumentParser(
   description="""
@@ -13,7 +19,31 @@ parser = argparse.ArgumentParser(
 parser.add_argument("-p", "--provider", required = True, 
                     help = "provider to use. It can be mistral or google or the pulled ollama model")
 
+parser.add_argument("--answer-cache", action = "store_true",
+                    help = "reuse the answer of a previous similar question with the same retrieved documents")
+parser.add_argument("--answer-cache-threshold", type = float, default = 0.95,
+                    help = "minimum cosine similarity between questions to reuse an answer")
+parser.add_argument("--answer-cache-ttl", type = float, default = 3600,
+                    help = "time in seconds during which an answer can be reused")
+parser.add_argument("--candidates", type = int, default = 30,
+                    help = "number of documents retrieved from the vectordb before packing the context")
+parser.add_argument("--context-tokens", type = int, default = 3000,
+                    help = "token budget of the retrieved documents in the prompt")
+
+parser.add_argument("--hybrid", action = "store_true",
+                    help = "fuse the dense and BM25 searches, to better match identifiers like P68871 or TP53")
+parser.add_argument("--retriever", choices = ["qdrant", "numpy"], default = "qdrant",
+                    help = "search backend, numpy searches the flat export of the index in-process (dense search only)")
+parser.add_argument("--batch",
+                    help = "answer the questions of a JSONL file (- for stdin) instead of the examples, and write the results as JSONL")
+parser.add_argument("-o", "--output", default = "-",
+                    help = "JSONL file of the batch results (- for stdout)")
+parser.add_argument("--concurrency", type = int, default = 8,
+                    help = "maximum number of concurrent LLM calls in batch mode")
 args = parser.parse_args()
+retriever = get_retriever(args.retriever)
+
+answer_cache = SemanticCache(args.answer_cache_threshold, args.answer_cache_ttl) if args.answer_cache else None
 
 def load_chat_model(model: str) -> BaseChatModel:
   provider, model_name = model.split("/", maxsplit=1)
@@ -39,6 +69,10 @@ def load_chat_model(model: str) -> BaseChatModel:
     # https://python.langchain.com/docs/integrations/chat/ollama/
     from langchain_ollama import ChatOllama
     return ChatOllama(model=model_name, temperature=0)
+  elif provider == "fake":
+    # Local stand-in answering at a fixed rate, to run offline (see bench.py e2e)
+    from fakellm import FakeChatModel
+    return FakeChatModel()
 
 SYSTEM_PROMPT = """You are an assistant that helps users to navigate the resources and databases from the SIB Swiss Institute of Bioinformatics.
 
@@ -52,31 +86,70 @@ And briefly explain the query.
 Here is a list of documents relevant to the user question that will help you answer the user question accurately:
 {context}"""
 
+@traced("answer")
 def ask(question: str):
   # Generate embeddings for the user question
-  question_embeddings = next(iter(embedding_model.embed([question])))
-  
-  # Find similar embeddings in the vector database
-  retrieved_docs = vectordb.query_points(
-    collection_name=collection_name,
-    query=question_embeddings,
-    limit=10,
-  )
-  print(f"📚️ Retrieved {len(retrieved_docs.points)} documents")
-  formatted_docs = ""
-  for doc in retrieved_docs.points:
-    if doc.payload.get("description"):
-      formatted_docs += f"\n{doc.payload['description']}"
-    else:
-      formatted_docs += f"\n{doc.payload.get('question')}:\n\n```sparql\n#+ endpoint: {doc.payload.get('endpoint_url')}\n{doc.payload.get('answer')}\n```\n"
+  question_embeddings = embed_question(question)
+
+  # Find the documents with similar embeddings in the vector database
+  points = retriever.search(question, limit=args.candidates, hybrid=args.hybrid)
+  formatted_docs, packed, tokens = pack_context(points, args.context_tokens)
+  print(f"📚️ Retrieved {len(points)} documents, {len(packed)} packed in the context ({tokens} tokens)")
+  doc_ids = [doc.id for doc in packed]
+  if answer_cache and (answer := answer_cache.get(question_embeddings, None, doc_ids, index_version())):
+    print(f"♻️ Cached answer {answer_cache.stats()}\n\n{answer}")
+    return
   messages = [
     ("system", SYSTEM_PROMPT.format(context=formatted_docs)),
     ("human", question),
   ]
-  for resp in llm.stream(messages):
-    print(resp.content, end="")
-    if resp.usage_metadata:
-      print(f"\n\n{resp.usage_metadata}")
+  answer = ""
+  with span("generate") as current:
+    for resp in llm.stream(messages):
+      current.token()
+      print(resp.content, end="")
+      answer += resp.content
+      if resp.usage_metadata:
+        print(f"\n\n{resp.usage_metadata}")
+        current.set(input_tokens=resp.usage_metadata["input_tokens"], output_tokens=resp.usage_metadata["output_tokens"])
+  if answer_cache:
+    answer_cache.put(question_embeddings, None, doc_ids, answer, index_version())
+
+async def ask_batch(items: list[dict]) -> list[dict]:
+  """Answer a batch of questions: one embedding call, one vectordb call and concurrent LLM calls."""
+  questions = [item["question"] for item in items]
+  timings: dict[str, float] = {}
+  with stage(timings, "embed"):
+    question_embeddings = embed_questions(questions)
+  with stage(timings, "search"):
+    results = retriever.search_batch(
+      [(question, None) for question in questions], args.candidates, args.hybrid, question_embeddings
+    )
+  with stage(timings, "pack"):
+    contexts = [pack_context(points, args.context_tokens) for points in results]
+  doc_ids = [[doc.id for doc in packed] for _, packed, _ in contexts]
+  responses: list = [
+    answer_cache.get(embeddings, None, ids, index_version()) if answer_cache else None
+    for embeddings, ids in zip(question_embeddings, doc_ids)
+  ]
+  # Only generate the answers missing from the cache
+  missing = [i for i, response in enumerate(responses) if response is None]
+  with stage(timings, "generate"):
+    generated = await llm.abatch(
+      [[("system", SYSTEM_PROMPT.format(context=contexts[i][0])), ("human", questions[i])] for i in missing],
+      config={"max_concurrency": args.concurrency},
+      return_exceptions=True,
+    ) if missing else []
+  for i, response in zip(missing, generated):
+    responses[i] = response
+    if answer_cache and not isinstance(response, Exception):
+      answer_cache.put(question_embeddings[i], None, doc_ids[i], response.content, index_version())
+  outputs = [
+    result(item, response, packed, tokens, timings, len(items))
+    for item, response, (_, packed, tokens) in zip(items, responses, contexts)
+  ]
+  print_summary(timings, outputs)
+  return outputs
 
 ## call
 if args.provider == "mistral":
@@ -85,13 +158,19 @@ elif args.provider == "google":
   llm = load_chat_model("google/gemini-2.0-flash")
 elif args.provider == "olama":
   llm = load_chat_model("ollama/mistral")
+elif args.provider == "fake":
+  llm = load_chat_model("fake/fake")
 else:
   raise ValueError(f"Unknown provider: {args.provider}")
 
 ## call
-ask("What is the HGNC symbol for the protein P68871?")
-print("\n------\n")
-ask("Where is the ACE2 gene expressed in humans?")
-print("\n------\n")
-ask("What are the rat orthologs of the human TP53 gene?")
+if args.batch:
+  # One event loop for the whole batch, the async clients of the providers are bound to it
+  write_results(asyncio.run(ask_batch(read_questions(args.batch))), args.output)
+else:
+  ask("What is the HGNC symbol for the protein P68871?")
+  print("\n------\n")
+  ask("Where is the ACE2 gene expressed in humans?")
+  print("\n------\n")
+  ask("What are the rat orthologs of the human TP53 gene?")
 
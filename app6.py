@@ -1,8 +1,14 @@
+import asyncio
 import argparse
 from langchain_core.language_models import BaseChatModel
-from index import vectordb, embedding_model, collection_name
+from index import intents, embed_question, embed_questions, index_version, classify_intent
+from retriever import get_retriever
+from tracing import span, traced, in_context
+from batch import read_questions, write_results, stage, result, print_summary
+from cache import SemanticCache, LRUCache, normalize
+from context import pack_context
 from typing import Annotated, TypedDict, Literal
-from qdrant_client.models import FieldCondition, Filter, MatchValue
+from concurrent.futures import ThreadPoolExecutor
 
 parser = argparse.ArgumentParser(
   description="""
@@ -14,8 +20,40 @@ parser = argparse.ArgumentParser(
 
 parser.add_argument("-p", "--provider", required = True, 
                     help = "provider to use. It can be mistral or google or the pulled ollama model")
+parser.add_argument("-s", "--speculative", action = "store_true",
+                    help = "search with the raw question for both intents while the intent is extracted")
+parser.add_argument("--requery-threshold", type = float, default = 0.5,
+                    help = "in speculative mode, search again with the reformulated question when its word overlap with the question is below this threshold")
+parser.add_argument("--answer-cache", action = "store_true",
+                    help = "reuse the answer of a previous similar question with the same retrieved documents")
+parser.add_argument("--answer-cache-threshold", type = float, default = 0.95,
+                    help = "minimum cosine similarity between questions to reuse an answer")
+parser.add_argument("--answer-cache-ttl", type = float, default = 3600,
+                    help = "time in seconds during which an answer can be reused")
+parser.add_argument("--extraction-cache-path",
+                    help = "sqlite file persisting the extracted intents and reformulated questions across runs")
+parser.add_argument("--intent-margin", type = float,
+                    help = "skip the LLM extraction when the local intent classifier margin is above this value (e.g. 0.1)")
+parser.add_argument("--candidates", type = int, default = 30,
+                    help = "number of documents retrieved from the vectordb before packing the context")
+parser.add_argument("--context-tokens", type = int, default = 3000,
+                    help = "token budget of the retrieved documents in the prompt")
 
+parser.add_argument("--hybrid", action = "store_true",
+                    help = "fuse the dense and BM25 searches, to better match identifiers like P68871 or TP53")
+parser.add_argument("--retriever", choices = ["qdrant", "numpy"], default = "qdrant",
+                    help = "search backend, numpy searches the flat export of the index in-process (dense search only)")
+parser.add_argument("--batch",
+                    help = "answer the questions of a JSONL file (- for stdin) instead of the examples, and write the results as JSONL")
+parser.add_argument("-o", "--output", default = "-",
+                    help = "JSONL file of the batch results (- for stdout)")
+parser.add_argument("--concurrency", type = int, default = 8,
+                    help = "maximum number of concurrent LLM calls in batch mode")
 args = parser.parse_args()
+retriever = get_retriever(args.retriever)
+
+answer_cache = SemanticCache(args.answer_cache_threshold, args.answer_cache_ttl) if args.answer_cache else None
+extraction_cache = LRUCache(maxsize=1024, path=args.extraction_cache_path, table="extracted_questions")
 
 class ExtractedQuestion(TypedDict):
   intent: Annotated[Literal["general_information", "sparql_query"], "Intent extracted from the user question"]
@@ -45,6 +83,10 @@ def load_chat_model(model: str) -> BaseChatModel:
     # https://python.langchain.com/docs/integrations/chat/ollama/
     from langchain_ollama import ChatOllama
     return ChatOllama(model=model_name, temperature=0)
+  elif provider == "fake":
+    # Local stand-in answering at a fixed rate, to run offline (see bench.py e2e)
+    from fakellm import FakeChatModel
+    return FakeChatModel()
 
 
 SYSTEM_PROMPT = """You are an assistant that helps users to navigate the resources and databases from the SIB Swiss Institute of Bioinformatics.
@@ -64,50 +106,147 @@ EXTRACT_PROMPT = """Given a user question:
 - Reformulate the question to make it more straigthforward and adapted to running a semantic similarity search"""
 
 
-def ask(question: str) -> str:
+def word_overlap(a: str, b: str) -> float:
+  """Jaccard similarity between the sets of words of two texts."""
+  words_a, words_b = set(a.lower().split()), set(b.lower().split())
+  return len(words_a & words_b) / max(len(words_a | words_b), 1)
+
+@traced("extract")
+def extract(question: str) -> ExtractedQuestion:
+  key = f"{args.provider}:{normalize(question)}"
+  if extracted := extraction_cache.get(key):
+    print(f"♻️ Cached extraction {extracted}")
+    return extracted
+  if args.intent_margin is not None:
+    intent, margin = classify_intent(embed_question(question), retriever.intent_centroids())
+    if margin >= args.intent_margin:
+      extracted = ExtractedQuestion(intent=intent, reformulated=question)
+      print(f"🎯 Classified {extracted} (margin {margin:.3f})")
+      return extracted
   extracted: ExtractedQuestion = structured_llm.invoke([
     ("system", EXTRACT_PROMPT),
     ("user", question),
   ])
   print(extracted)
-  if extracted["intent"] == "general_information":
-    query_filter = Filter(
-      must=[FieldCondition(
-        key="doc_type",
-        match=MatchValue(value="General information"),
-      )]
+  extraction_cache.put(key, extracted)
+  return extracted
+
+def speculative_search(question: str) -> tuple[ExtractedQuestion, list]:
+  """Search with the raw question for both intents while the intent is being extracted."""
+  with ThreadPoolExecutor(max_workers=1) as pool:
+    extraction = pool.submit(in_context(extract, question))
+    general, sparql = retriever.search_batch(
+      [(question, intent) for intent in intents],
+      limit=args.candidates,
+      hybrid=args.hybrid,
     )
+    extracted = extraction.result()
+  # Keep the results matching the intent, unless the reformulation changed the question too much
+  if word_overlap(question, extracted["reformulated"]) < args.requery_threshold:
+    return extracted, retriever.search(extracted["reformulated"], extracted["intent"], args.candidates, args.hybrid)
+  return extracted, general if extracted["intent"] == "general_information" else sparql
+
+@traced("answer")
+def ask(question: str) -> str:
+  if args.speculative:
+    extracted, points = speculative_search(question)
   else:
-    query_filter = Filter(
-      must_not=[FieldCondition(
-        key="doc_type",
-        match=MatchValue(value="General information"),
-      )]
-    )
-  # Use reformulated question when querying the vectordb
-  question_embeddings = next(iter(embedding_model.embed([extracted["reformulated"]])))
-  # Add query filters
-  retrieved_docs = vectordb.query_points(
-    collection_name=collection_name,
-    query=question_embeddings,
-    query_filter=query_filter,
-    limit=10,
-  )
-  print(f"📚️ Retrieved {len(retrieved_docs.points)} documents")
-  formatted_docs = ""
-  for doc in retrieved_docs.points:
-    if doc.payload.get("description"):
-      formatted_docs += f"\n{doc.payload['description']}"
-    else:
-      formatted_docs += f"\n{doc.payload.get('question')}:\n\n```sparql\n#+ endpoint: {doc.payload.get('endpoint_url')}\n{doc.payload.get('answer')}\n```\n"
+    extracted = extract(question)
+    # Use reformulated question when querying the vectordb, and add query filters
+    points = retriever.search(extracted["reformulated"], extracted["intent"], args.candidates, args.hybrid)
+  formatted_docs, packed, tokens = pack_context(points, args.context_tokens)
+  print(f"📚️ Retrieved {len(points)} documents, {len(packed)} packed in the context ({tokens} tokens)")
+  # The reformulated question is used as key, as it is closer to the intent than the raw question
+  reformulated_embeddings = embed_question(extracted["reformulated"])
+  doc_ids = [doc.id for doc in packed]
+  if answer_cache and (answer := answer_cache.get(reformulated_embeddings, extracted["intent"], doc_ids, index_version())):
+    print(f"♻️ Cached answer {answer_cache.stats()}\n\n{answer}")
+    return
   messages = [
     ("system",SYSTEM_PROMPT.format(context=formatted_docs)),
     ("human", question),
   ]
-  for resp in llm.stream(messages):
-    print(resp.content, end="")
-    if resp.usage_metadata:
-      print(f"\n\n{resp.usage_metadata}")
+  answer = ""
+  with span("generate") as current:
+    for resp in llm.stream(messages):
+      current.token()
+      print(resp.content, end="")
+      answer += resp.content
+      if resp.usage_metadata:
+        print(f"\n\n{resp.usage_metadata}")
+        current.set(input_tokens=resp.usage_metadata["input_tokens"], output_tokens=resp.usage_metadata["output_tokens"])
+  if answer_cache:
+    answer_cache.put(reformulated_embeddings, extracted["intent"], doc_ids, answer, index_version())
+
+async def extract_batch(questions: list[str]) -> list[ExtractedQuestion]:
+  """Extract the intents of a batch of questions, with concurrent LLM calls for the ones not cached or classified."""
+  keys = [f"{args.provider}:{normalize(question)}" for question in questions]
+  extracted: list = [extraction_cache.get(key) for key in keys]
+  missing = [i for i, extraction in enumerate(extracted) if not extraction]
+  if not missing:
+    return extracted
+  if args.intent_margin is not None:
+    for i, embedding in zip(missing, embed_questions([questions[i] for i in missing])):
+      intent, margin = classify_intent(embedding, retriever.intent_centroids())
+      if margin >= args.intent_margin:
+        extracted[i] = ExtractedQuestion(intent=intent, reformulated=questions[i])
+  unclassified = [i for i in missing if not extracted[i]]
+  responses = await structured_llm.abatch(
+    [[("system", EXTRACT_PROMPT), ("user", questions[i])] for i in unclassified],
+    config={"max_concurrency": args.concurrency},
+    return_exceptions=True,
+  ) if unclassified else []
+  for i, response in zip(unclassified, responses):
+    if isinstance(response, Exception):
+      # Fall back on the local classifier, even below the margin, to still answer the question
+      intent, _ = classify_intent(embed_question(questions[i]), retriever.intent_centroids())
+      extracted[i] = ExtractedQuestion(intent=intent, reformulated=questions[i])
+    else:
+      extracted[i] = response
+      extraction_cache.put(keys[i], response)
+  return extracted
+
+async def ask_batch(items: list[dict]) -> list[dict]:
+  """Answer a batch of questions: concurrent extractions, one embedding call, one vectordb call and concurrent LLM calls."""
+  questions = [item["question"] for item in items]
+  timings: dict[str, float] = {}
+  with stage(timings, "extract"):
+    extracted = await extract_batch(questions)
+  reformulated = [extraction["reformulated"] for extraction in extracted]
+  with stage(timings, "embed"):
+    reformulated_embeddings = embed_questions(reformulated)
+  with stage(timings, "search"):
+    results = retriever.search_batch(
+      [(question, extraction["intent"]) for question, extraction in zip(reformulated, extracted)],
+      args.candidates,
+      args.hybrid,
+      reformulated_embeddings,
+    )
+  with stage(timings, "pack"):
+    contexts = [pack_context(points, args.context_tokens) for points in results]
+  doc_ids = [[doc.id for doc in packed] for _, packed, _ in contexts]
+  responses: list = [
+    answer_cache.get(embeddings, extraction["intent"], ids, index_version()) if answer_cache else None
+    for embeddings, extraction, ids in zip(reformulated_embeddings, extracted, doc_ids)
+  ]
+  # Only generate the answers missing from the cache
+  missing = [i for i, response in enumerate(responses) if response is None]
+  with stage(timings, "generate"):
+    generated = await llm.abatch(
+      [[("system", SYSTEM_PROMPT.format(context=contexts[i][0])), ("human", questions[i])] for i in missing],
+      config={"max_concurrency": args.concurrency},
+      return_exceptions=True,
+    ) if missing else []
+  for i, response in zip(missing, generated):
+    responses[i] = response
+    if answer_cache and not isinstance(response, Exception):
+      answer_cache.put(reformulated_embeddings[i], extracted[i]["intent"], doc_ids[i], response.content, index_version())
+  outputs = [
+    {**result(item, response, packed, tokens, timings, len(items)), **extraction}
+    for item, response, extraction, (_, packed, tokens) in zip(items, responses, extracted, contexts)
+  ]
+  print_summary(timings, outputs)
+  return outputs
 
 
 ## call
@@ -117,15 +256,21 @@ elif args.provider == "google":
   llm = load_chat_model("google/gemini-2.0-flash")
 elif args.provider == "olama":
   llm = load_chat_model("ollama/mistral")
+elif args.provider == "fake":
+  llm = load_chat_model("fake/fake")
 else:
   raise ValueError(f"Unknown provider: {args.provider}")
 
 structured_llm = llm.with_structured_output(ExtractedQuestion)
 
 ## call
-ask("What is the HGNC symbol for the protein P68871?")
-print("\n------\n")
-ask("Where is the ACE2 gene expressed in humans?")
-print("\n------\n")
-ask("What are the rat orthologs of the human TP53 gene?")
+if args.batch:
+  # One event loop for the whole batch, the async clients of the providers are bound to it
+  write_results(asyncio.run(ask_batch(read_questions(args.batch))), args.output)
+else:
+  ask("What is the HGNC symbol for the protein P68871?")
+  print("\n------\n")
+  ask("Where is the ACE2 gene expressed in humans?")
+  print("\n------\n")
+  ask("What are the rat orthologs of the human TP53 gene?")
 
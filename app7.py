@@ -1,10 +1,18 @@
-import time
 import os
+import json
+import asyncio
+import hashlib
+import functools
 import chainlit as cl
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.language_models import BaseChatModel
-from index import vectordb, embedding_model, collection_name
+from index import get_embedding_model, get_sparse_model, intents, embed_question, question_cache, index_version, classify_intent
+from cache import SemanticCache, LRUCache, normalize
+from context import pack_context, ChatHistory
 from typing import Annotated, TypedDict, Literal
-from qdrant_client.models import FieldCondition, Filter, MatchValue
+from ratelimit import rate_limited, RateLimitedChatModel
+from retriever import get_retriever
+from tracing import span, in_context, get_sink, add_collector, PrometheusSink
 
 
 class ExtractedQuestion(TypedDict):
@@ -36,8 +44,46 @@ def load_chat_model(model: str) -> BaseChatModel:
     # https://python.langchain.com/docs/integrations/chat/ollama/
     from langchain_ollama import ChatOllama
     return ChatOllama(model=model_name, temperature=0)
+  elif provider == "fake":
+    # Local stand-in answering at a fixed rate, to run offline (see bench.py e2e)
+    from fakellm import FakeChatModel
+    return FakeChatModel()
 
 
+## chat models shared by all the sessions of the process, keyed by provider/model, so that
+# each session reuses the same clients and their pools of open HTTP connections
+provider_models = {
+  "mistral": "mistral/mistral-large-latest",
+  "google": "google/gemini-2.0-flash",
+  "ollama": "ollama/mistral",
+  "fake": "fake/fake",
+}
+chat_models: dict[str, tuple[RateLimitedChatModel, RateLimitedChatModel]] = {}
+# Connection warm-up of each model, referenced so that the task is not garbage collected before it finishes
+warm_tasks: dict[str, asyncio.Task] = {}
+
+def get_chat_models(provider: str) -> tuple[RateLimitedChatModel, RateLimitedChatModel]:
+  """Generation and intent extraction models of the provider, created on first use."""
+  if provider not in provider_models:
+    raise ValueError(f"Unknown provider: {provider}")
+  model = provider_models[provider]
+  if model not in chat_models:
+    # Share the provider quota between all chat sessions
+    llm = rate_limited(load_chat_model(model), provider)
+    chat_models[model] = (llm, llm.with_structured_output(ExtractedQuestion))
+    warm_tasks[model] = asyncio.get_running_loop().create_task(warm_chat_model(llm))
+  return chat_models[model]
+
+async def warm_chat_model(llm: RateLimitedChatModel) -> None:
+  """Open a connection to the provider API (DNS, TCP and TLS) before the first question."""
+  client = getattr(llm.model, "async_client", None)
+  if client is None or not hasattr(client, "get"):
+    return
+  try:
+    await client.get("models")
+  except Exception as e:
+    print(f"⚠️ Could not warm the connection to the provider: {e!r}")
+
 @cl.on_chat_start
 async def on_chat_start():
   """Initializes the chat session and LLM based on environment variable."""
@@ -45,19 +91,19 @@ async def on_chat_start():
   provider = os.environ.get("LLM_PROVIDER")
   if not provider:
     raise ValueError("LLM_PROVIDER environment variable must be set")
-  
-  global llm, structured_llm
-  
-  if provider == "mistral":
-    llm = load_chat_model("mistral/mistral-large-latest")
-  elif provider == "google":
-    llm = load_chat_model("google/gemini-2.0-flash")
-  elif provider == "ollama":
-    llm = load_chat_model("ollama/mistral")
-  else:
-    raise ValueError(f"Unknown provider: {provider}")
-      
-  structured_llm = llm.with_structured_output(ExtractedQuestion)
+
+  # The models are shared, the session only keeps its handles on them
+  llm, structured_llm = get_chat_models(provider)
+  cl.user_session.set("llm", llm)
+  cl.user_session.set("structured_llm", structured_llm)
+  cl.user_session.set("history", ChatHistory(functools.partial(summarize_history, llm), turns=history_turns))
+
+  # Load the embedding model and open the vectordb in the background, before the first question
+  loop = asyncio.get_running_loop()
+  loop.run_in_executor(retrieval_pool, get_embedding_model)
+  loop.run_in_executor(retrieval_pool, retriever.warm)
+  if hybrid_search:
+    loop.run_in_executor(retrieval_pool, get_sparse_model)
   
   # Display initial message with example questions
   await cl.Message(content=f"Chat initialized with {provider} provider. Below are some example questions you can ask:\n"
@@ -86,64 +132,208 @@ EXTRACT_PROMPT = """Given a user question:
 - Extract the intent of the question: either "sparql_query" (query available resources to answer biomedical questions), or "general_informations" (tools available, infos about the resources)
 - Reformulate the question to make it more straigthforward and adapted to running a semantic similarity search"""
 
-@cl.on_message
-async def on_message(msg: cl.Message):
-  """Main function to handle when user send a message to the assistant."""
-  extracted: ExtractedQuestion = structured_llm.invoke([
-    ("system", EXTRACT_PROMPT),
-    *cl.chat_context.to_openai(), # Pass the whole chat history
-  ])
-  time.sleep(1) # To avoid quota limitations
-  
-  # Show extraction results
-  async with cl.Step(name="extracted ⚗️") as step:
-    step.output = extracted
-
-  # Filter based on intent
-  if extracted["intent"] == "general_information":
-    query_filter = Filter(
-      must=[FieldCondition(
-        key="doc_type",
-        match=MatchValue(value="General information"),
-      )]
-    )
-  else:
-    query_filter = Filter(
-      must_not=[FieldCondition(
-        key="doc_type",
-        match=MatchValue(value="General information"),
-      )]
-    )
+# Embedding and Qdrant search are blocking calls: run them on a worker pool so
+# that one session's retrieval does not freeze the event loop for the others
+retrieval_pool = ThreadPoolExecutor(
+  max_workers=int(os.environ.get("RETRIEVAL_WORKERS", 4)),
+  thread_name_prefix="retrieval",
+)
+# Retrieve more candidates than fit in the prompt, and pack the best ones within the token budget
+retrieval_candidates = int(os.environ.get("RETRIEVAL_CANDIDATES", 30))
+context_tokens = int(os.environ.get("CONTEXT_TOKENS", 3000))
+# Fuse the dense and BM25 searches with HYBRID_SEARCH=1
+hybrid_search = os.environ.get("HYBRID_SEARCH", "0") == "1"
+# Search backend: qdrant, or numpy to search the flat export of the index in-process
+retriever = get_retriever(os.environ.get("RETRIEVER", "qdrant"))
+
+def search(question: str, intent: str) -> list:
+  """Embed the question and query the vectordb for the intent (blocking, run it in retrieval_pool)."""
+  return retriever.search(question, intent, retrieval_candidates, hybrid_search)
 
-  # Get embeddings and query vectordb
-  question_embeddings = next(iter(embedding_model.embed([extracted["reformulated"]])))
-  retrieved_docs = vectordb.query_points(
-    collection_name=collection_name,
-    query=question_embeddings,
-    query_filter=query_filter,
-    limit=10,
+def search_all_intents(question: str) -> tuple[list, list]:
+  """Embed the question and query the vectordb with the filter of each intent (blocking)."""
+  general, sparql = retriever.search_batch(
+    [(question, intent) for intent in intents],
+    retrieval_candidates,
+    hybrid_search,
   )
-  
-  # Format retrieved documents
-  formatted_docs = ""
-  for doc in retrieved_docs.points:
-    if doc.payload.get("description"):
-      formatted_docs += f"\n{doc.payload['description']}"
+  return general, sparql
+
+def word_overlap(a: str, b: str) -> float:
+  """Jaccard similarity between the sets of words of two texts."""
+  words_a, words_b = set(a.lower().split()), set(b.lower().split())
+  return len(words_a & words_b) / max(len(words_a | words_b), 1)
+
+# Speculative mode: search with the raw question for both intents while the intent is
+# extracted, and search again only if the reformulated question differs too much from it
+speculative_search = os.environ.get("SPECULATIVE_SEARCH", "0") == "1"
+requery_threshold = float(os.environ.get("REQUERY_THRESHOLD", 0.5))
+
+# Answers cache shared by all sessions, enabled with ANSWER_CACHE=1
+answer_cache = SemanticCache(
+  threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.95)),
+  ttl=float(os.environ.get("ANSWER_CACHE_TTL", 3600)),
+) if os.environ.get("ANSWER_CACHE", "0") == "1" else None
+
+# Extracted intents cache shared by all sessions, persisted with EXTRACTION_CACHE_PATH=data/extractions.sqlite
+extraction_cache = LRUCache(
+  maxsize=int(os.environ.get("EXTRACTION_CACHE_SIZE", 1024)),
+  path=os.environ.get("EXTRACTION_CACHE_PATH"),
+  table="extracted_questions",
+)
+
+def cache_metrics() -> list[tuple[str, dict[str, str], float]]:
+  """Stats of the caches, served at /metrics with TRACING=prometheus."""
+  caches = {"questions": question_cache, "extractions": extraction_cache, "answers": answer_cache}
+  return [
+    (f"cache_{key}", {"cache": name}, value)
+    for name, cache in caches.items() if cache is not None
+    for key, value in cache.stats().items()
+  ]
+add_collector(cache_metrics)
+# Skip the LLM extraction when the local intent classifier margin is above INTENT_MARGIN (e.g. 0.1)
+intent_margin = float(os.environ["INTENT_MARGIN"]) if os.environ.get("INTENT_MARGIN") else None
+
+def classify_question(question: str) -> tuple[str, float]:
+  """Intent of a question with the local classifier (blocking, the centroids are computed on first use)."""
+  return classify_intent(embed_question(question), retriever.intent_centroids())
+
+async def extract(chat_history: list, structured_llm: RateLimitedChatModel) -> ExtractedQuestion:
+  """Extract the intent of the last question, from the cache, the local classifier or the LLM."""
+  loop = asyncio.get_running_loop()
+  question = chat_history[-1]["content"]
+  context_hash = hashlib.sha256(json.dumps(chat_history[:-1], sort_keys=True).encode()).hexdigest()[:16]
+  key = f"{os.environ.get('LLM_PROVIDER')}:{context_hash}:{normalize(question)}"
+  with span("extract") as current:
+    # The cache may be read from sqlite, off the event loop
+    if extracted := await loop.run_in_executor(retrieval_pool, extraction_cache.get, key):
+      current.set(source="cache")
+      return extracted
+    # The classifier ignores the chat history, only use it for the first question of a session
+    if intent_margin is not None and not any(message["role"] == "user" for message in chat_history[:-1]):
+      intent, margin = await loop.run_in_executor(retrieval_pool, in_context(classify_question, question))
+      if margin >= intent_margin:
+        current.set(source="classifier", margin=round(margin, 3))
+        return ExtractedQuestion(intent=intent, reformulated=question)
+    current.set(source="llm")
+    extracted: ExtractedQuestion = await structured_llm.ainvoke([
+      ("system", EXTRACT_PROMPT),
+      *chat_history, # Pass the recent chat history
+    ])
+  await loop.run_in_executor(retrieval_pool, extraction_cache.put, key, extracted)
+  return extracted
+
+async def show_step(name: str, output) -> None:
+  """Display an intermediate result in the chainlit UI."""
+  async with cl.Step(name=name) as step:
+    step.output = output
+
+async def answer_question(
+  extraction_history: list,
+  chat_history: list,
+  show_step,
+  stream_token,
+  llm: RateLimitedChatModel,
+  structured_llm: RateLimitedChatModel,
+) -> None:
+  """Async RAG pipeline: extract the intent, retrieve documents and stream the answer.
+
+  The intent is extracted from the short `extraction_history` with `structured_llm`, and the
+  answer is generated from `chat_history` with `llm`, the models of the session.
+  `show_step(name, output)` and `stream_token(token)` are awaited to report intermediate results
+  and answer tokens, so that the pipeline can also be driven outside chainlit.
+  """
+  # One trace per question, whose spans show the time spent in each stage
+  with span("answer", provider=os.environ.get("LLM_PROVIDER")) as answer_span:
+    loop = asyncio.get_running_loop()
+    extraction = extract(extraction_history, structured_llm)
+    if speculative_search:
+      question = extraction_history[-1]["content"]
+      speculative = loop.run_in_executor(retrieval_pool, in_context(search_all_intents, question))
+    extracted: ExtractedQuestion = await extraction
+
+    # Show extraction results
+    await show_step("extracted ⚗️", extracted)
+
+    # Get embeddings and query vectordb, filtering based on intent
+    if speculative_search and word_overlap(question, extracted["reformulated"]) >= requery_threshold:
+      general, sparql = await speculative
+      points = general if extracted["intent"] == "general_information" else sparql
     else:
-      formatted_docs += f"\n{doc.payload.get('question')}:\n\n```sparql\n#+ endpoint: {doc.payload.get('endpoint_url')}\n{doc.payload.get('answer')}\n```\n"
+      points = await loop.run_in_executor(
+        retrieval_pool, in_context(search, extracted["reformulated"], extracted["intent"])
+      )
+
+    # Format and show retrieved documents
+    formatted_docs, packed, tokens = pack_context(points, context_tokens)
+    await show_step(f"{len(packed)} relevant documents 📚️ ({tokens} tokens)", formatted_docs)
+
+    # The reformulated question is used as key, as it carries the context of the chat history
+    if answer_cache:
+      reformulated_embeddings = await loop.run_in_executor(retrieval_pool, in_context(embed_question, extracted["reformulated"]))
+      doc_ids = [doc.id for doc in packed]
+      if answer := answer_cache.get(reformulated_embeddings, extracted["intent"], doc_ids, index_version()):
+        answer_span.set(cached=True)
+        await stream_token(answer)
+        return
+
+    answer = ""
+    with span("generate") as current:
+      async for resp in llm.astream([
+        ("system", SYSTEM_PROMPT.format(context=formatted_docs)),
+        *chat_history,
+      ]):
+        current.token()
+        await stream_token(resp.content)
+        answer += resp.content
+        if resp.usage_metadata:
+          current.set(input_tokens=resp.usage_metadata["input_tokens"], output_tokens=resp.usage_metadata["output_tokens"])
+    if answer_cache:
+      answer_cache.put(reformulated_embeddings, extracted["intent"], doc_ids, answer, index_version())
+
+SUMMARY_PROMPT = """Summarize the conversation between a user and an assistant helping to navigate the resources and databases from the SIB Swiss Institute of Bioinformatics.
+Update the current summary with the new messages. Keep the resources, genes, proteins, species and SPARQL endpoints mentioned, and what the user is trying to achieve. Answer with the summary only."""
 
-  # Show retrieved documents
-  async with cl.Step(name=f"{len(retrieved_docs.points)} relevant documents 📚️") as step:
-    step.output = formatted_docs
+# History window: the last HISTORY_TURNS messages are kept verbatim and the older ones summarized,
+# within HISTORY_TOKENS for the answer generation. The intent extraction only gets the last EXTRACTION_TURNS messages
+history_turns = int(os.environ.get("HISTORY_TURNS", 6))
+history_tokens = int(os.environ.get("HISTORY_TOKENS", 4000))
+extraction_turns = int(os.environ.get("EXTRACTION_TURNS", 3))
+extraction_tokens = int(os.environ.get("EXTRACTION_TOKENS", 1000))
 
+async def summarize_history(llm: RateLimitedChatModel, summary: str, messages: list[dict]) -> str:
+  """Fold messages into the rolling summary of the conversation."""
+  transcript = "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+  with span("summarize", messages=len(messages)):
+    resp = await llm.ainvoke([
+      ("system", SUMMARY_PROMPT),
+      ("user", f"Current summary: {summary or 'none'}\n\nNew messages:\n{transcript}"),
+    ])
+  return resp.content
+
+@cl.on_message
+async def on_message(msg: cl.Message):
+  """Main function to handle when user send a message to the assistant."""
+  history: ChatHistory = cl.user_session.get("history")
+  messages = cl.chat_context.to_openai()
   answer = cl.Message(content="")
-  for resp in llm.stream([
-    ("system", SYSTEM_PROMPT.format(context=formatted_docs)),
-    *cl.chat_context.to_openai(),
-  ]):
-    await answer.stream_token(resp.content)
-    if resp.usage_metadata:
-      print(resp.usage_metadata)
+  await answer_question(
+    history.view(messages, extraction_tokens, turns=extraction_turns, with_summary=False),
+    history.view(messages, history_tokens),
+    show_step,
+    answer.stream_token,
+    cl.user_session.get("llm"),
+    cl.user_session.get("structured_llm"),
+  )
   await answer.send()
+  # Summarize the older messages once answered, so that it does not delay the next answer
+  cl.user_session.set("fold", asyncio.create_task(history.fold(cl.chat_context.to_openai())))
 
+# Serve the metrics of the stages on the chainlit server at /metrics, with TRACING=prometheus
+if metrics := get_sink(PrometheusSink):
+  from chainlit.server import app as server
+  from fastapi.responses import PlainTextResponse
 
+  @server.get("/metrics")
+  async def serve_metrics() -> PlainTextResponse:
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
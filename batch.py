@@ -0,0 +1,59 @@
+import sys
+import json
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+## batch mode of the apps: answer a JSONL file of questions, e.g. a nightly evaluation set
+def read_questions(path: str) -> list[dict]:
+  """Read the questions of a JSONL file, or of stdin if `path` is "-".
+
+  Each line is a JSON string, or an object with a "question" field whose other fields are kept in the results.
+  """
+  f = sys.stdin if path == "-" else open(path)
+  try:
+    items = [json.loads(line) for line in f if line.strip()]
+  finally:
+    if f is not sys.stdin:
+      f.close()
+  return [{"question": item} if isinstance(item, str) else item for item in items]
+
+def write_results(results: list[dict], path: str) -> None:
+  """Write the results as JSONL to a file, or to stdout if `path` is "-"."""
+  f = sys.stdout if path == "-" else open(path, "w")
+  try:
+    for result in results:
+      f.write(json.dumps(result, default=str) + "\n")
+  finally:
+    if f is not sys.stdout:
+      f.close()
+
+@contextmanager
+def stage(timings: dict[str, float], name: str) -> Iterator[None]:
+  """Add the time spent in the block to the timing of the stage."""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def result(item: dict, response, packed: list, tokens: int, timings: dict[str, float], n_questions: int) -> dict:
+  """Result of a question: its answer (or error), the packed documents and the stage timings amortized over the batch."""
+  output = {
+    **item,
+    "documents": [str(point.id) for point in packed],
+    "context_tokens": tokens,
+    "timings": {name: round(seconds / n_questions, 4) for name, seconds in timings.items()},
+  }
+  if isinstance(response, Exception):
+    output["error"] = repr(response)
+  else:
+    output["answer"] = getattr(response, "content", response)
+  return output
+
+def print_summary(timings: dict[str, float], results: list[dict]) -> None:
+  """Print the total time of each stage on stderr, not to mix it with the results on stdout."""
+  errors = sum("error" in result for result in results)
+  print(f"✅ {len(results) - errors} questions answered, {errors} errors", file=sys.stderr)
+  for name, seconds in timings.items():
+    print(f"  ⏱️ {name}: {seconds:.2f}s ({seconds / max(len(results), 1) * 1000:.0f} ms/question)", file=sys.stderr)
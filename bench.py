@@ -0,0 +1,644 @@
+import io
+import os
+import sys
+import time
+import functools
+import threading
+import contextlib
+import statistics
+import subprocess
+import asyncio
+import argparse
+import itertools
+from fakellm import FakeChatModel
+
+## example questions from app7.py on_chat_start
+QUESTIONS: list[str] = [
+  "Which tools can I use for comparative genomics?",
+  "Which is the best SIB tool for comparative genomics?",
+  "Which resources should I use to study the evolution of a protein?",
+  "What is the HGNC symbol for the P68871 protein?",
+  "Where is the ACE2 gene expressed in humans?",
+  "What are the rat orthologs of the human TP53 gene?",
+]
+
+## questions with a payload field and a value expected in one of the retrieved documents
+RECALL_QUESTIONS: list[tuple[str, str, str]] = [
+  ("What is the HGNC symbol for the protein P68871?", "endpoint_url", "sparql.uniprot.org"),
+  ("Find the UniProt entries annotated with the GO term GO:0005634", "endpoint_url", "sparql.uniprot.org"),
+  ("Where is the ACE2 gene expressed in humans?", "endpoint_url", "bgee.org"),
+  ("In which anatomical entities is the APOC1 gene expressed?", "endpoint_url", "bgee.org"),
+  ("What are the rat orthologs of the human TP53 gene?", "endpoint_url", "omabrowser.org"),
+  ("Which mouse proteins are orthologous to the human BRCA1 protein?", "endpoint_url", "omabrowser.org"),
+  ("Which Rhea reactions involve ATP as a substrate?", "endpoint_url", "rhea-db.org"),
+  ("Get the reactions catalyzed by the enzyme EC 1.1.1.1", "endpoint_url", "rhea-db.org"),
+  ("Which resource provides gene expression data across animal species?", "description", "Bgee"),
+  ("Which database contains orthology relationships between genomes?", "description", "OMA"),
+  ("Where can I find curated biochemical reactions?", "description", "Rhea"),
+  ("Which resource provides protein sequences and functional annotations?", "description", "UniProt"),
+]
+
+async def noop_step(name: str, output) -> None:
+  pass
+
+async def noop_token(token: str) -> None:
+  pass
+
+## load test
+async def run_sessions(n_sessions: int, questions: list[str], llm: FakeChatModel) -> float:
+  """Run `n_sessions` concurrent chat sessions through app7 and return the throughput (questions/s)."""
+  import app7
+  structured_llm = llm.with_structured_output(app7.ExtractedQuestion)
+
+  async def session():
+    for question in questions:
+      messages = [{"role": "user", "content": question}]
+      await app7.answer_question(messages, messages, noop_step, noop_token, llm, structured_llm)
+
+  start = time.perf_counter()
+  await asyncio.gather(*(session() for _ in range(n_sessions)))
+  return n_sessions * len(questions) / (time.perf_counter() - start)
+
+def bench_load(args: argparse.Namespace) -> None:
+  import app7
+  from cache import LRUCache
+  llm = FakeChatModel(latency=args.latency, tokens_per_second=args.tokens_per_second)
+  # Measure the pipeline itself, not the extractions cache
+  app7.extraction_cache = LRUCache(maxsize=0)
+  print(f"{'sessions':>8} {'questions/s':>12}")
+  for n_sessions in args.sessions:
+    throughput = asyncio.run(run_sessions(n_sessions, QUESTIONS, llm))
+    print(f"{n_sessions:>8} {throughput:>12.2f}")
+
+## embedding throughput
+def bench_embed(args: argparse.Namespace) -> None:
+  from index import embed_batches, worker_threads
+  texts = [f"{question} ({i})" for i, question in zip(range(args.docs), itertools.cycle(QUESTIONS))]
+  print(f"{'workers':>8} {'threads':>8} {'docs/s':>10}")
+  for parallel in args.workers:
+    # The workers share the cores, as in index.py, so that each run uses all of them
+    threads = worker_threads(parallel)
+    start = time.perf_counter()
+    for _ in embed_batches(itertools.batched(texts, args.batch_size), parallel, threads):
+      pass
+    print(f"{parallel:>8} {threads:>8} {len(texts) / (time.perf_counter() - start):>10.1f}")
+
+## retrieval quality
+def recall_at_k(k: int, hybrid: bool) -> float:
+  """Fraction of the RECALL_QUESTIONS with an expected document in the top k."""
+  from retriever import get_retriever
+  found = 0
+  for question, field, expected in RECALL_QUESTIONS:
+    points = get_retriever("qdrant").search(question, limit=k, hybrid=hybrid)
+    found += any(expected.lower() in str(point.payload.get(field, "")).lower() for point in points)
+  return found / len(RECALL_QUESTIONS)
+
+def bench_recall(args: argparse.Namespace) -> None:
+  print(f"{'k':>4} {'dense':>8} {'hybrid':>8}")
+  for k in args.k:
+    print(f"{k:>4} {recall_at_k(k, False):>8.2f} {recall_at_k(k, True):>8.2f}")
+
+## filtered search latency
+def bench_filter(args: argparse.Namespace) -> None:
+  from index import search, manifest_info, intents
+  modes = {"no filter": (False, False), "filter": (True, False)}
+  if manifest_info().get("partitioned"):
+    modes["sub-collection"] = (True, True)
+  else:
+    print("⚠️ Build the index with --partition to also measure the per-intent sub-collections")
+  print(f"{'mode':<16} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+  for mode, (filtered, partitioned) in modes.items():
+    timings = []
+    for _ in range(args.repeat):
+      for question in QUESTIONS:
+        for intent in intents:
+          start = time.perf_counter()
+          search(question, intent if filtered else None, args.limit, args.hybrid, partitioned)
+          timings.append((time.perf_counter() - start) * 1000)
+    p50, p95 = statistics.quantiles(timings, n=20)[9], statistics.quantiles(timings, n=20)[18]
+    print(f"{mode:<16} {p50:>9.2f} {p95:>9.2f}")
+
+## storage options
+def server_memory(url: str) -> float | None:
+  """Memory allocated by the Qdrant server in MB, from its telemetry (None if it does not report it)."""
+  import httpx
+  try:
+    memory = httpx.get(f"{url}/telemetry", timeout=10).raise_for_status().json()["result"].get("memory") or {}
+  except (httpx.HTTPError, KeyError, ValueError):
+    return None
+  return memory["allocated_bytes"] / 2**20 if "allocated_bytes" in memory else None
+
+def wait_indexed(vectordb, collection: str, count: int, timeout: float = 600) -> None:
+  """Wait until the server built the HNSW index of all the vectors of the collection."""
+  from qdrant_client.models import CollectionStatus
+  deadline = time.monotonic() + timeout
+  while True:
+    info = vectordb.get_collection(collection)
+    if info.status == CollectionStatus.GREEN and (info.indexed_vectors_count or 0) >= count:
+      return
+    if time.monotonic() > deadline:
+      print(f"⚠️ {collection} is not indexed after {timeout:.0f}s ({info.indexed_vectors_count}/{count} vectors)")
+      return
+    time.sleep(0.5)
+
+def bench_storage(args: argparse.Namespace) -> None:
+  import numpy as np
+  from qdrant_client.models import SearchParams, OptimizersConfigDiff
+  from index import (
+    get_vectordb, vectordb_url, collection_name, dense_vector_name,
+    storage_config, collection_config, search_params, embed_question,
+  )
+  vectordb = get_vectordb()
+  if not vectordb_url:
+    print("⚠️ The embedded store ignores quantization, on-disk and HNSW options, set QDRANT_URL to benchmark a server")
+
+  # Copy the dense vectors of the index in a collection created with each configuration
+  ids, vectors, offset = [], [], None
+  while True:
+    points, offset = vectordb.scroll(collection_name, limit=1024, offset=offset, with_vectors=[dense_vector_name])
+    ids += [point.id for point in points]
+    vectors += [point.vector[dense_vector_name] for point in points]
+    if offset is None:
+      break
+  vectors = np.array(vectors, dtype=np.float32)
+  queries = [embed_question(question).tolist() for question in QUESTIONS + [question for question, _, _ in RECALL_QUESTIONS]]
+  exact = [
+    {point.id for point in vectordb.query_points(
+      collection_name, query=query, using=dense_vector_name, limit=10, search_params=SearchParams(exact=True)
+    ).points}
+    for query in queries
+  ]
+
+  configs = {
+    "float32": storage_config(),
+    "float32 on disk": storage_config(on_disk=True),
+    "scalar": storage_config("scalar"),
+    "scalar on disk": storage_config("scalar", on_disk=True),
+    "binary": storage_config("binary"),
+    "binary on disk": storage_config("binary", on_disk=True),
+  }
+  bench_collection = f"{collection_name}-bench"
+  print(f"{len(ids)} vectors")
+  print(f"{'config':<16} {'RAM (MB)':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'recall@10':>10}")
+  for name, storage in configs.items():
+    if vectordb.collection_exists(bench_collection):
+      vectordb.delete_collection(bench_collection)
+    before = server_memory(vectordb_url) if vectordb_url else None
+    # This corpus is below the default indexing threshold (20000 KB), without which the server would never build
+    # the HNSW graph and the quantized vectors, and scan the original vectors instead
+    vectordb.create_collection(
+      bench_collection, **collection_config(storage), optimizers_config=OptimizersConfigDiff(indexing_threshold=1)
+    )
+    vectordb.upload_collection(bench_collection, vectors={dense_vector_name: vectors}, ids=ids, wait=True)
+    if vectordb_url:
+      wait_indexed(vectordb, bench_collection, len(ids))
+    after = server_memory(vectordb_url) if vectordb_url else None
+    params = search_params(storage)
+    timings, found = [], 0
+    for _ in range(args.repeat):
+      for query, expected in zip(queries, exact):
+        start = time.perf_counter()
+        points = vectordb.query_points(bench_collection, query=query, using=dense_vector_name, limit=10, search_params=params).points
+        timings.append((time.perf_counter() - start) * 1000)
+        found += len(expected & {point.id for point in points})
+    # Memory allocated by the server for the collection, the on-disk vectors are in the page cache instead
+    memory = f"{after - before:.1f}" if before is not None and after is not None else "-"
+    quantiles = statistics.quantiles(timings, n=20)
+    recall = found / (args.repeat * sum(len(expected) for expected in exact))
+    print(f"{name:<16} {memory:>9} {quantiles[9]:>9.2f} {quantiles[18]:>9.2f} {recall:>10.3f}")
+  vectordb.delete_collection(bench_collection)
+
+## search backends
+def bench_retriever(args: argparse.Namespace) -> None:
+  from index import intents
+  from retriever import get_retriever
+  qdrant, flat = get_retriever("qdrant"), get_retriever("numpy")
+  queries = [(question, intent) for question in QUESTIONS for intent in (None, *intents)]
+  # Embed the questions once, to only measure the search
+  flat.search_batch(queries, args.limit)
+  print(f"{'retriever':<10} {'mode':<8} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+  for name, retriever in (("qdrant", qdrant), ("numpy", flat)):
+    for mode, batch_size in (("single", 1), ("batch", len(queries))):
+      timings = []
+      for _ in range(args.repeat):
+        for batch in itertools.batched(queries, batch_size):
+          start = time.perf_counter()
+          retriever.search_batch(list(batch), args.limit)
+          timings.append((time.perf_counter() - start) * 1000 / len(batch))
+      quantiles = statistics.quantiles(timings, n=20)
+      print(f"{name:<10} {mode:<8} {quantiles[9]:>9.3f} {quantiles[18]:>9.3f}")
+  # Qdrant approximates the search with HNSW on a server, the numpy search is exact
+  overlap = [
+    len({str(point.id) for point in expected} & {hit.id for hit in found}) / max(len(expected), 1)
+    for expected, found in zip(qdrant.search_batch(queries, args.limit), flat.search_batch(queries, args.limit))
+  ]
+  print(f"Overlap of the top {args.limit} documents: {statistics.mean(overlap):.3f}")
+
+## end-to-end latency of the apps, offline with the fake LLM and a frozen index
+FIXTURE_RESOURCES: list[dict[str, str]] = [
+  {"title": "UniProt", "url": "https://www.uniprot.org", "category": "Proteins",
+   "description": "The Universal Protein Resource provides protein sequences and functional annotations.",
+   "ontology_terms": "protein sequence, protein function, proteome"},
+  {"title": "Bgee", "url": "https://www.bgee.org", "category": "Genes and genomes",
+   "description": "Bgee is a database of gene expression data across animal species, in anatomical entities and developmental stages.",
+   "ontology_terms": "gene expression, anatomy, developmental stage"},
+  {"title": "OMA", "url": "https://omabrowser.org", "category": "Evolution",
+   "description": "The OMA browser infers orthology relationships between complete genomes, to study the evolution of genes and proteins.",
+   "ontology_terms": "orthology, comparative genomics, phylogeny"},
+  {"title": "Rhea", "url": "https://www.rhea-db.org", "category": "Chemistry",
+   "description": "Rhea is an expert curated knowledgebase of biochemical reactions.",
+   "ontology_terms": "biochemical reaction, enzyme, metabolism"},
+  {"title": "SWISS-MODEL", "url": "https://swissmodel.expasy.org", "category": "Structural biology",
+   "description": "SWISS-MODEL is a server for the homology modelling of protein 3D structures.",
+   "ontology_terms": "protein structure, homology modelling"},
+  {"title": "STRING", "url": "https://string-db.org", "category": "Proteins",
+   "description": "STRING is a database of known and predicted protein-protein interactions.",
+   "ontology_terms": "protein interaction, network"},
+  {"title": "Cellosaurus", "url": "https://www.cellosaurus.org", "category": "Cell lines",
+   "description": "Cellosaurus is a knowledge resource on the cell lines used in biomedical research.",
+   "ontology_terms": "cell line"},
+  {"title": "ENZYME", "url": "https://enzyme.expasy.org", "category": "Chemistry",
+   "description": "ENZYME is a repository of the nomenclature of enzymes, based on the EC numbers.",
+   "ontology_terms": "enzyme nomenclature, EC number"},
+]
+
+## (question, endpoint, query) SPARQL examples of the fixture index
+FIXTURE_EXAMPLES: list[tuple[str, str, str]] = [
+  ("What is the HGNC symbol for the protein P68871?", "https://sparql.uniprot.org/sparql/",
+   "SELECT ?symbol WHERE { <http://purl.uniprot.org/uniprot/P68871> rdfs:seeAlso ?hgnc . ?hgnc up:database <http://purl.uniprot.org/database/HGNC> ; rdfs:comment ?symbol . }"),
+  ("Find the UniProt entries annotated with the GO term GO:0005634", "https://sparql.uniprot.org/sparql/",
+   "SELECT ?protein WHERE { ?protein a up:Protein ; up:classifiedWith <http://purl.obolibrary.org/obo/GO_0005634> . }"),
+  ("Where is the ACE2 gene expressed in humans?", "https://www.bgee.org/sparql/",
+   "SELECT ?anat WHERE { ?seq a orth:Gene ; rdfs:label \"ACE2\" ; genex:isExpressedIn ?anat ; orth:organism/obo:RO_0002162 taxon:9606 . }"),
+  ("In which anatomical entities is the APOC1 gene expressed?", "https://www.bgee.org/sparql/",
+   "SELECT ?anat WHERE { ?seq a orth:Gene ; rdfs:label \"APOC1\" ; genex:isExpressedIn ?anat . }"),
+  ("What are the rat orthologs of the human TP53 gene?", "https://sparql.omabrowser.org/sparql/",
+   "SELECT ?rat WHERE { ?cluster a orth:OrthologsCluster ; orth:hasHomologousMember ?node1, ?node2 . ?node1 orth:hasHomologousMember* ?human . ?human rdfs:label \"TP53\" . ?node2 orth:hasHomologousMember* ?rat . ?rat orth:organism/obo:RO_0002162 taxon:10116 . }"),
+  ("Which Rhea reactions involve ATP as a substrate?", "https://sparql.rhea-db.org/sparql/",
+   "SELECT ?reaction WHERE { ?reaction rh:side/rh:contains/rh:compound/rh:chebi CHEBI:30616 . }"),
+  ("Get the reactions catalyzed by the enzyme EC 1.1.1.1", "https://sparql.rhea-db.org/sparql/",
+   "SELECT ?reaction WHERE { ?reaction rh:ec <http://purl.uniprot.org/enzyme/1.1.1.1> . }"),
+]
+
+fixture_path = "data/bench-fixture"
+STAGES = ("extraction", "embedding", "retrieval", "prompt assembly", "first token", "total")
+
+def build_fixture() -> str:
+  """Index the fixture documents in a store of their own, and point the apps to it.
+
+  Returns the CSV of the fixture resources, served to app3 instead of the upstream one.
+  """
+  import csv
+  import io
+  import index
+  from langchain_core.documents import Document
+  os.makedirs(fixture_path, exist_ok=True)
+  resources = io.StringIO()
+  writer = csv.DictWriter(resources, fieldnames=list(FIXTURE_RESOURCES[0]))
+  writer.writeheader()
+  writer.writerows(FIXTURE_RESOURCES)
+  with open(f"{fixture_path}/resources.csv", "w") as f:
+    f.write(resources.getvalue())
+  # The embedded store of the fixture is used whatever QDRANT_URL
+  index.vectordb_url = None
+  index.vectordb_path = f"{fixture_path}/vectordb"
+  index.builds_path = f"{fixture_path}/vectordb-builds"
+  index.manifest_path = f"{fixture_path}/vectordb-manifest.json"
+  examples = [
+    Document(page_content=question, metadata={
+      "question": question,
+      "answer": query,
+      "endpoint_url": endpoint,
+      "query_type": "SelectQuery",
+      "doc_type": "SPARQL endpoints query examples",
+    })
+    for question, endpoint, query in FIXTURE_EXAMPLES
+  ]
+  # The documents are hashed, so the fixture is only embedded and built on the first run
+  index.sync_collection(index.load_resources_csv(f"{fixture_path}/resources.csv") + examples)
+  return resources.getvalue()
+
+class StageTimer:
+  """Latency samples of the pipeline stages.
+
+  The time spent in a stage nested in another one of the same thread (e.g. the embedding done
+  by the retrieval) is only counted in the nested stage. When `sequential`, the first stage
+  of a question starts its clock, and the answer stream stops it.
+  """
+  def __init__(self, sequential: bool = False):
+    self.sequential = sequential
+    self.samples: dict[str, list[float]] = {stage: [] for stage in STAGES}
+    self.local = threading.local()
+    self.question_start: float | None = None
+
+  def start_question(self) -> None:
+    if self.sequential and self.question_start is None:
+      self.question_start = time.perf_counter()
+
+  @contextlib.contextmanager
+  def stage(self, name: str):
+    self.start_question()
+    stack = self.local.__dict__.setdefault("stack", [])
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - start
+      self.samples[name].append(elapsed - stack.pop())
+      if stack:
+        stack[-1] += elapsed
+
+  def timed(self, name: str, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with self.stage(name):
+        return func(*args, **kwargs)
+    return wrapper
+
+@contextlib.contextmanager
+def patched(target, name: str, value):
+  """Replace an attribute of a module or class within the block."""
+  original = getattr(target, name)
+  setattr(target, name, value)
+  try:
+    yield
+  finally:
+    setattr(target, name, original)
+
+@contextlib.contextmanager
+def instrument(timer: StageTimer, resources_csv: str):
+  """Time the stages of the apps, and serve the fixture resources to app3."""
+  import fakellm
+  import httpcache
+  import index
+  import context
+  import retriever
+
+  class TimedFakeChatModel(fakellm.FakeChatModel):
+    def extract(self, messages: list) -> dict:
+      with timer.stage("extraction"):
+        return super().extract(messages)
+
+    async def aextract(self, messages: list) -> dict:
+      start = time.perf_counter()
+      try:
+        return await super().aextract(messages)
+      finally:
+        timer.samples["extraction"].append(time.perf_counter() - start)
+
+    def _stream(self, *args, **kwargs):
+      timer.start_question()
+      first_token = None
+      for chunk in super()._stream(*args, **kwargs):
+        if first_token is None:
+          first_token = time.perf_counter()
+          timer.samples["first token"].append(first_token - timer.question_start)
+        yield chunk
+      timer.samples["total"].append(time.perf_counter() - timer.question_start)
+      timer.question_start = None
+
+  with contextlib.ExitStack() as stack:
+    stack.enter_context(patched(fakellm, "FakeChatModel", TimedFakeChatModel))
+    stack.enter_context(patched(index, "embed_questions", timer.timed("embedding", index.embed_questions)))
+    stack.enter_context(patched(retriever, "embed_questions", index.embed_questions))
+    for cls in (retriever.QdrantRetriever, retriever.NumpyRetriever):
+      stack.enter_context(patched(cls, "search_batch", timer.timed("retrieval", cls.search_batch)))
+    stack.enter_context(patched(context, "pack_context", timer.timed("prompt assembly", context.pack_context)))
+    stack.enter_context(patched(httpcache, "fetch", lambda url: resources_csv.encode()))
+    yield TimedFakeChatModel
+
+def percentiles(samples: list[float]) -> tuple[float, float, float]:
+  """p50, p95 and p99 of the samples."""
+  if len(samples) < 2:
+    return (samples[0],) * 3 if samples else (float("nan"),) * 3
+  quantiles = statistics.quantiles(samples, n=100, method="inclusive")
+  return quantiles[49], quantiles[94], quantiles[98]
+
+def print_stages(title: str, timer: StageTimer) -> None:
+  print(f"\n{title}")
+  print(f"  {'stage':<16} {'n':>5} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+  for stage, samples in timer.samples.items():
+    if samples:
+      p50, p95, p99 = (value * 1000 for value in percentiles(samples))
+      print(f"  {stage:<16} {len(samples):>5} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}")
+
+def run_script(app: str, repeat: int) -> None:
+  """Run the example questions of a script app with the fake provider, `repeat` times."""
+  import runpy
+  import index
+  argv = sys.argv
+  try:
+    for _ in range(repeat):
+      index.question_cache.clear()
+      sys.argv = [app, "-p", "fake"]
+      with contextlib.redirect_stdout(io.StringIO()):
+        runpy.run_path(app, run_name="__main__")
+  finally:
+    sys.argv = argv
+
+async def run_app7(n_sessions: int, timer: StageTimer, llm: FakeChatModel) -> float:
+  """Run `n_sessions` concurrent app7 sessions asking the QUESTIONS, return the throughput (questions/s)."""
+  import app7
+  structured_llm = llm.with_structured_output(app7.ExtractedQuestion)
+
+  async def session():
+    for question in QUESTIONS:
+      messages = [{"role": "user", "content": question}]
+      start = time.perf_counter()
+      first_token = None
+
+      async def stream_token(token: str) -> None:
+        nonlocal first_token
+        if first_token is None:
+          first_token = time.perf_counter()
+          timer.samples["first token"].append(first_token - start)
+
+      await app7.answer_question(messages, messages, noop_step, stream_token, llm, structured_llm)
+      timer.samples["total"].append(time.perf_counter() - start)
+
+  start = time.perf_counter()
+  await asyncio.gather(*(session() for _ in range(n_sessions)))
+  return n_sessions * len(QUESTIONS) / (time.perf_counter() - start)
+
+def bench_e2e(args: argparse.Namespace) -> None:
+  # The apps create their fake model from the environment
+  os.environ["FAKE_LLM_LATENCY"] = str(args.latency)
+  os.environ["FAKE_LLM_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+  os.environ["FAKE_LLM_ANSWER_TOKENS"] = str(args.answer_tokens)
+  resources_csv = build_fixture()
+  for app in args.apps:
+    if app == "app7.py":
+      continue
+    timer = StageTimer(sequential=True)
+    with instrument(timer, resources_csv):
+      run_script(app, args.repeat)
+    print_stages(app, timer)
+
+  if "app7.py" in args.apps:
+    import app7
+    import context
+    from cache import LRUCache
+    # Measure the pipeline itself, not the extractions cache
+    app7.extraction_cache = LRUCache(maxsize=0)
+    for n_sessions in args.sessions:
+      timer = StageTimer()
+      # app7 imported pack_context before it was instrumented
+      with instrument(timer, resources_csv) as TimedFakeChatModel, patched(app7, "pack_context", context.pack_context):
+        throughput = asyncio.run(run_app7(n_sessions, timer, TimedFakeChatModel()))
+      print_stages(f"app7.py, {n_sessions} sessions: {throughput:.2f} questions/s", timer)
+
+## first question of a session
+async def first_questions(n_sessions: int, provider: str, shared: bool) -> list[float]:
+  """Time from the start of a session to the first answer token of its first question, for `n_sessions` sessions.
+
+  With `shared`, the sessions get their models from the app7 registry, otherwise each one
+  creates its own clients, as on_chat_start did before the registry. The first session also
+  loads the embedding model and opens the vectordb, so it is not counted.
+  """
+  import app7
+  import index
+  samples = []
+  for i in range(n_sessions + 1):
+    index.question_cache.clear()
+    start = time.perf_counter()
+    if shared:
+      llm, structured_llm = app7.get_chat_models(provider)
+    else:
+      llm = app7.rate_limited(app7.load_chat_model(app7.provider_models[provider]), provider)
+      structured_llm = llm.with_structured_output(app7.ExtractedQuestion)
+    first_token = None
+
+    async def stream_token(token: str) -> None:
+      nonlocal first_token
+      if first_token is None:
+        first_token = time.perf_counter()
+
+    messages = [{"role": "user", "content": QUESTIONS[i % len(QUESTIONS)]}]
+    await app7.answer_question(messages, messages, noop_step, stream_token, llm, structured_llm)
+    if i > 0:
+      samples.append(first_token - start)
+  return samples
+
+def bench_first(args: argparse.Namespace) -> None:
+  os.environ["FAKE_LLM_LATENCY"] = str(args.latency)
+  os.environ["FAKE_LLM_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+  os.environ["LLM_PROVIDER"] = args.provider
+  build_fixture()
+  import app7
+  from cache import LRUCache
+  # Measure the pipeline itself, not the extractions cache
+  app7.extraction_cache = LRUCache(maxsize=0)
+  print(f"{'models':<12} {'sessions':>8} {'p50 (ms)':>9} {'p95 (ms)':>9}")
+  for shared in (False, True):
+    app7.chat_models.clear()
+    samples = asyncio.run(first_questions(args.sessions, args.provider, shared))
+    p50, p95, _ = (value * 1000 for value in percentiles(samples))
+    print(f"{'shared' if shared else 'per session':<12} {len(samples):>8} {p50:>9.1f} {p95:>9.1f}")
+
+## import time
+def bench_import(args: argparse.Namespace) -> None:
+  commands = {
+    "import index": [sys.executable, "-c", "import index"],
+    **{f"{app} --help": [sys.executable, app, "--help"] for app in ("app4.py", "app5.py", "app6.py")},
+    "app6.py -p unknown": [sys.executable, "app6.py", "-p", "unknown"],
+    "load embedding model": [sys.executable, "-c", "import index; index.get_embedding_model()"],
+    "open vectordb": [sys.executable, "-c", "import index; index.get_vectordb()"],
+  }
+  print(f"{'command':<24} {'median (s)':>10}")
+  for name, command in commands.items():
+    timings = []
+    for _ in range(args.repeat):
+      start = time.perf_counter()
+      subprocess.run(command, capture_output=True)
+      timings.append(time.perf_counter() - start)
+    print(f"{name:<24} {statistics.median(timings):>10.3f}")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description="""
+    - run: uv run bench.py <benchmark> [options]
+    - help: uv run bench.py <benchmark> --help
+    """,
+    formatter_class = argparse.RawDescriptionHelpFormatter
+  )
+  subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+  load = subparsers.add_parser("load", help="throughput of app7 with concurrent chat sessions")
+  load.add_argument("-s", "--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                    help="number of concurrent chat sessions to test")
+  load.add_argument("--latency", type=float, default=0.5,
+                    help="latency in seconds of the fake LLM before answering")
+  load.add_argument("--tokens-per-second", type=float, default=50.0,
+                    help="streaming rate of the fake LLM")
+  load.set_defaults(func=bench_load)
+
+  embed = subparsers.add_parser("embed", help="embedding throughput of index builds with multiple processes")
+  embed.add_argument("-w", "--workers", type=int, nargs="+",
+                     default=sorted({1, 2, 4, os.cpu_count() // 2 or 1, os.cpu_count()}),
+                     help="number of embedding worker processes to test")
+  embed.add_argument("-n", "--docs", type=int, default=10_000,
+                     help="number of documents to embed")
+  embed.add_argument("--batch-size", type=int, default=256,
+                     help="number of documents embedded at once")
+  embed.set_defaults(func=bench_embed)
+
+  recall = subparsers.add_parser("recall", help="recall@k of the dense and hybrid searches")
+  recall.add_argument("-k", type=int, nargs="+", default=[1, 3, 5, 10],
+                      help="number of retrieved documents to test")
+  recall.set_defaults(func=bench_recall)
+
+  filtered = subparsers.add_parser("filter", help="latency of the searches filtered on the intent")
+  filtered.add_argument("-r", "--repeat", type=int, default=20,
+                        help="number of runs of each question")
+  filtered.add_argument("-l", "--limit", type=int, default=30,
+                        help="number of retrieved documents")
+  filtered.add_argument("--hybrid", action="store_true",
+                        help="use the hybrid dense and BM25 search")
+  filtered.set_defaults(func=bench_filter)
+
+  storage = subparsers.add_parser("storage", help="memory, latency and recall of the quantization and on-disk options")
+  storage.add_argument("-r", "--repeat", type=int, default=10,
+                       help="number of runs of each question")
+  storage.set_defaults(func=bench_storage)
+
+  retriever = subparsers.add_parser("retriever", help="latency of the qdrant and numpy search backends")
+  retriever.add_argument("-r", "--repeat", type=int, default=20,
+                         help="number of runs of each question")
+  retriever.add_argument("-l", "--limit", type=int, default=30,
+                         help="number of retrieved documents")
+  retriever.set_defaults(func=bench_retriever)
+
+  e2e = subparsers.add_parser("e2e", help="latency of each stage of app3-7, offline with the fake LLM and a fixture index")
+  e2e.add_argument("--apps", nargs="+", default=["app3.py", "app4.py", "app5.py", "app6.py", "app7.py"],
+                   help="apps to benchmark")
+  e2e.add_argument("-r", "--repeat", type=int, default=3,
+                   help="number of runs of the example questions of app3-6")
+  e2e.add_argument("-s", "--sessions", type=int, nargs="+", default=[1, 4, 16],
+                   help="number of concurrent app7 chat sessions to test")
+  e2e.add_argument("--latency", type=float, default=0.2,
+                   help="latency in seconds of the fake LLM before answering")
+  e2e.add_argument("--tokens-per-second", type=float, default=200.0,
+                   help="streaming rate of the fake LLM")
+  e2e.add_argument("--answer-tokens", type=int, default=50,
+                   help="number of tokens of the fake LLM answers")
+  e2e.set_defaults(func=bench_e2e)
+
+  first = subparsers.add_parser("first", help="latency of the first question of new app7 sessions, with and without shared models")
+  first.add_argument("-p", "--provider", default="fake",
+                     help="LLM provider of the sessions, a real one measures the connection setup")
+  first.add_argument("-s", "--sessions", type=int, default=10,
+                     help="number of sessions started one after the other")
+  first.add_argument("--latency", type=float, default=0.2,
+                     help="latency in seconds of the fake LLM before answering")
+  first.add_argument("--tokens-per-second", type=float, default=200.0,
+                     help="streaming rate of the fake LLM")
+  first.set_defaults(func=bench_first)
+
+  imports = subparsers.add_parser("import", help="startup time of the apps, which should not load the model")
+  imports.add_argument("-r", "--repeat", type=int, default=5,
+                       help="number of runs of each command")
+  imports.set_defaults(func=bench_import)
+
+  args = parser.parse_args()
+  args.func(args)
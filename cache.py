@@ -0,0 +1,173 @@
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+
+def normalize(text: str) -> str:
+  """Normalize a text used as cache key: lower case and collapsed whitespaces."""
+  return " ".join(text.lower().split())
+
+class LRUCache:
+  """Thread-safe bounded LRU cache, with hit-rate metrics and an optional sqlite tier.
+
+  When `path` is given, entries are also written to a sqlite database so that they
+  survive restarts, and entries evicted from memory are read back from it on a miss.
+  The database keeps the `disk_maxsize` entries accessed last. Numpy arrays are stored
+  as raw bytes, the other values as JSON.
+  """
+  def __init__(self, maxsize: int = 1024, path: str | None = None, table: str = "cache", disk_maxsize: int = 100_000):
+    self.maxsize = maxsize
+    self.disk_maxsize = disk_maxsize
+    self.entries: OrderedDict = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.db = None
+    self.disk_size = 0
+    self.table = table
+    if path:
+      self.db = sqlite3.connect(path, check_same_thread=False)
+      columns = {row[1] for row in self.db.execute(f"PRAGMA table_info({table})")}
+      if columns and "accessed" not in columns:
+        # Table of pickled values written by a previous version
+        self.db.execute(f"DROP TABLE {table}")
+      self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, kind TEXT, value BLOB, accessed REAL)")
+      self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_accessed ON {table} (accessed)")
+      self.db.commit()
+      self.disk_size = self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+  @staticmethod
+  def encode(value) -> tuple[str, bytes]:
+    if isinstance(value, np.ndarray):
+      return f"ndarray {value.dtype.str} {','.join(map(str, value.shape))}", value.tobytes()
+    return "json", json.dumps(value).encode()
+
+  @staticmethod
+  def decode(kind: str, value: bytes):
+    if kind.startswith("ndarray"):
+      _, dtype, shape = kind.split(" ")
+      return np.frombuffer(value, dtype=dtype).reshape([int(size) for size in shape.split(",") if size])
+    return json.loads(value)
+
+  def get(self, key: str):
+    """Return the value cached for the key, or None."""
+    with self.lock:
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]
+      if self.db is not None:
+        row = self.db.execute(f"SELECT kind, value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row:
+          self.disk_hits += 1
+          self.db.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (time.time(), key))
+          self.db.commit()
+          value = self.decode(*row)
+          self._remember(key, value)
+          return value
+      self.misses += 1
+      return None
+
+  def put(self, key: str, value) -> None:
+    with self.lock:
+      self._remember(key, value)
+      if self.db is not None:
+        exists = self.db.execute(f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        self.db.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)", (key, *self.encode(value), time.time()))
+        self.disk_size += 0 if exists else 1
+        if self.disk_size > self.disk_maxsize:
+          # Evict the entries accessed least recently
+          self.db.execute(
+            f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY accessed LIMIT ?)",
+            (self.disk_size - self.disk_maxsize,),
+          )
+          self.disk_size = self.disk_maxsize
+        self.db.commit()
+
+  def _remember(self, key: str, value) -> None:
+    self.entries[key] = value
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.maxsize:
+      self.entries.popitem(last=False)
+
+  def clear(self) -> None:
+    with self.lock:
+      self.entries.clear()
+      if self.db is not None:
+        self.db.execute(f"DELETE FROM {self.table}")
+        self.db.commit()
+        self.disk_size = 0
+
+  def stats(self) -> dict:
+    with self.lock:
+      lookups = self.hits + self.disk_hits + self.misses
+      return {
+        "size": len(self.entries),
+        "maxsize": self.maxsize,
+        "disk_size": self.disk_size,
+        "hits": self.hits,
+        "disk_hits": self.disk_hits,
+        "misses": self.misses,
+        "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+      }
+
+class SemanticCache:
+  """Answers of previous questions, matched on the cosine similarity of the question embeddings.
+
+  An answer is reused only for a question with the same intent, the same retrieved documents
+  and the same index version, whose embedding is within `threshold` cosine similarity.
+  Entries expire after `ttl` seconds, and the least recently used are evicted beyond `maxsize`.
+  """
+  def __init__(self, threshold: float = 0.95, ttl: float = 3600, maxsize: int = 256):
+    self.threshold = threshold
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self.entries: OrderedDict[int, tuple] = OrderedDict()
+    self.next_id = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def _key(self, intent: str | None, doc_ids: list, version: str | None) -> tuple:
+    return (version, intent, tuple(str(id) for id in doc_ids))
+
+  def get(self, embedding: np.ndarray, intent: str | None, doc_ids: list, version: str | None = None) -> str | None:
+    """Return the answer of the most similar previous question, or None."""
+    key = self._key(intent, doc_ids, version)
+    embedding = embedding / np.linalg.norm(embedding)
+    now = time.monotonic()
+    with self.lock:
+      best_id, best_score = None, self.threshold
+      for id, (entry_key, entry_embedding, answer, created) in list(self.entries.items()):
+        if now - created > self.ttl:
+          del self.entries[id]
+        elif entry_key == key and (score := float(entry_embedding @ embedding)) >= best_score:
+          best_id, best_score = id, score
+      if best_id is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.entries.move_to_end(best_id)
+      return self.entries[best_id][2]
+
+  def put(self, embedding: np.ndarray, intent: str | None, doc_ids: list, answer: str, version: str | None = None) -> None:
+    with self.lock:
+      self.entries[self.next_id] = (
+        self._key(intent, doc_ids, version), embedding / np.linalg.norm(embedding), answer, time.monotonic()
+      )
+      self.next_id += 1
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+  def stats(self) -> dict:
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "size": len(self.entries),
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups else 0.0,
+      }
@@ -0,0 +1,83 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+from tracing import span
+
+def count_tokens(text: str) -> int:
+  """Rough token count of a text (~4 characters per token)."""
+  return len(text) // 4 + 1
+
+def trim(text: str, max_tokens: int) -> str:
+  """Cut a text to `max_tokens`, on a line boundary when possible."""
+  if count_tokens(text) <= max_tokens:
+    return text
+  text = text[:max_tokens * 4]
+  return (text.rsplit("\n", 1)[0] if "\n" in text else text) + "\n# ... (truncated)"
+
+def format_doc(payload: dict, max_answer_tokens: int = 500) -> str | None:
+  """Format a retrieved document: the description of a resource, or a SPARQL example."""
+  if payload.get("description"):
+    return f"\n{payload['description']}"
+  answer = trim(str(payload.get("answer")), max_answer_tokens)
+  return f"\n{payload.get('question')}:\n\n```sparql\n#+ endpoint: {payload.get('endpoint_url')}\n{answer}\n```\n"
+
+def pack_context(
+  points: list,
+  max_tokens: int = 3000,
+  formatter: Callable[[dict], str | None] = format_doc,
+) -> tuple[str, list, int]:
+  """Pack the formatted documents by decreasing score, skipping the ones that do not fit in `max_tokens`.
+
+  Returns the context, the packed points and the number of tokens used.
+  """
+  parts: list[str] = []
+  packed: list = []
+  used = 0
+  with span("pack_context", candidates=len(points)) as current:
+    for point in sorted(points, key=lambda point: point.score, reverse=True):
+      formatted = formatter(point.payload)
+      if not formatted:
+        continue
+      tokens = count_tokens(formatted)
+      if used + tokens > max_tokens:
+        continue
+      parts.append(formatted)
+      packed.append(point)
+      used += tokens
+    current.set(packed=len(packed), tokens=used)
+  return "".join(parts), packed, used
+
+class ChatHistory:
+  """Window over the chat history of a session: the last messages are kept verbatim, and
+  the older ones are folded into a rolling summary.
+
+  Folding happens in batches, once more than `2 * turns` messages are not summarized, so
+  that the `summarize(summary, messages)` LLM call runs every `turns` messages only.
+  """
+  def __init__(self, summarize: Callable[[str, list[dict]], Awaitable[str]], turns: int = 6):
+    self.summarize = summarize
+    self.turns = turns
+    self.summary = ""
+    self.summarized = 0
+    self.lock = asyncio.Lock()
+
+  def view(self, messages: list[dict], max_tokens: int, turns: int | None = None, with_summary: bool = True) -> list[dict]:
+    """Messages to send to the LLM: the summary and the last messages within `max_tokens`.
+
+    The last message is always kept. Without `turns`, all messages not summarized yet are candidates.
+    """
+    recent = messages[-turns:] if turns else messages[self.summarized:]
+    summary = [{"role": "system", "content": f"Summary of the earlier conversation: {self.summary}"}] if with_summary and self.summary else []
+    used = sum(count_tokens(str(message["content"])) for message in summary + recent)
+    while len(recent) > 1 and used > max_tokens:
+      used -= count_tokens(str(recent[0]["content"]))
+      recent = recent[1:]
+    return summary + recent
+
+  async def fold(self, messages: list[dict]) -> None:
+    """Fold the messages older than the window into the summary, when enough accumulated."""
+    async with self.lock:
+      if len(messages) - self.summarized <= 2 * self.turns:
+        return
+      older = messages[self.summarized:len(messages) - self.turns]
+      self.summary = await self.summarize(self.summary, older)
+      self.summarized += len(older)
@@ -0,0 +1,80 @@
+import os
+import re
+import time
+import asyncio
+from collections.abc import Iterator, AsyncIterator
+from pydantic import Field
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable, RunnableLambda
+
+def env_float(name: str, default: float) -> float:
+  return float(os.environ.get(name, default))
+
+class FakeChatModel(BaseChatModel):
+  """Local stand-in chat model, to run and benchmark the apps offline without a LLM provider.
+
+  It answers the same text after `latency` seconds, streamed at `tokens_per_second`, and its
+  structured output extracts the intent of the question with a keyword rule. The defaults are
+  read from FAKE_LLM_LATENCY, FAKE_LLM_TOKENS_PER_SECOND and FAKE_LLM_ANSWER_TOKENS.
+  """
+  latency: float = Field(default_factory=lambda: env_float("FAKE_LLM_LATENCY", 0.5))
+  tokens_per_second: float = Field(default_factory=lambda: env_float("FAKE_LLM_TOKENS_PER_SECOND", 50.0))
+  answer_tokens: int = Field(default_factory=lambda: int(env_float("FAKE_LLM_ANSWER_TOKENS", 100)))
+
+  @property
+  def _llm_type(self) -> str:
+    return "fake"
+
+  def _usage(self, messages: list[BaseMessage]) -> dict:
+    input_tokens = sum(len(str(message.content)) for message in messages) // 4 + 1
+    return {"input_tokens": input_tokens, "output_tokens": self.answer_tokens, "total_tokens": input_tokens + self.answer_tokens}
+
+  def _generate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+    time.sleep(self.latency + self.answer_tokens / self.tokens_per_second)
+    message = AIMessage(content="token " * self.answer_tokens, usage_metadata=self._usage(messages))
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+  async def _agenerate(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+    await asyncio.sleep(self.latency + self.answer_tokens / self.tokens_per_second)
+    message = AIMessage(content="token " * self.answer_tokens, usage_metadata=self._usage(messages))
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+  def _stream(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+    time.sleep(self.latency)
+    for i in range(self.answer_tokens):
+      time.sleep(1 / self.tokens_per_second)
+      usage = self._usage(messages) if i == self.answer_tokens - 1 else None
+      yield ChatGenerationChunk(message=AIMessageChunk(content="token ", usage_metadata=usage))
+
+  async def _astream(self, messages: list[BaseMessage], stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+    await asyncio.sleep(self.latency)
+    for i in range(self.answer_tokens):
+      await asyncio.sleep(1 / self.tokens_per_second)
+      usage = self._usage(messages) if i == self.answer_tokens - 1 else None
+      yield ChatGenerationChunk(message=AIMessageChunk(content="token ", usage_metadata=usage))
+
+  def extract(self, messages: list) -> dict:
+    """Mimic the structured output of the apps: an ExtractedQuestion for the last message."""
+    time.sleep(self.latency)
+    return extract_question(messages)
+
+  async def aextract(self, messages: list) -> dict:
+    await asyncio.sleep(self.latency)
+    return extract_question(messages)
+
+  def with_structured_output(self, schema, **kwargs) -> Runnable:
+    return RunnableLambda(self.extract, afunc=self.aextract)
+
+def extract_question(messages: list) -> dict:
+  """Intent of the last message: general information when it asks for tools or resources."""
+  message = messages[-1]
+  if isinstance(message, dict):
+    question = message["content"]
+  elif isinstance(message, tuple):
+    question = message[1]
+  else:
+    question = message.content
+  general = re.search(r"\b(tools?|resources?|databases?)\b", question, re.IGNORECASE)
+  return {"intent": "general_information" if general else "sparql_query", "reformulated": question}
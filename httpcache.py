@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import httpx
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from langchain_core.documents import Document
+
+## on-disk cache of the downloads, revalidated with ETag / Last-Modified
+# With HTTP_OFFLINE=1 (or index.py --offline), the last good copy is served without any request
+cache_dir = os.environ.get("HTTP_CACHE_DIR", "data/http-cache")
+offline = os.environ.get("HTTP_OFFLINE", "0") == "1"
+
+_client: httpx.Client | None = None
+_client_lock = threading.Lock()
+
+def get_client() -> httpx.Client:
+  """HTTP client shared by the downloads, keeping its connections open between them."""
+  global _client
+  with _client_lock:
+    if _client is None:
+      _client = httpx.Client(
+        follow_redirects=True,
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+      )
+  return _client
+
+def cache_path(key: str) -> str:
+  return f"{cache_dir}/{hashlib.sha256(key.encode()).hexdigest()[:32]}"
+
+def read_file(path: str) -> bytes:
+  with open(path, "rb") as f:
+    return f.read()
+
+def write_atomic(path: str, content: bytes) -> None:
+  """Replace a file atomically, through a temporary file of its own for each writer."""
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path), suffix=".tmp", delete=False) as f:
+    f.write(content)
+  os.replace(f.name, path)
+
+def fetch(url: str) -> bytes:
+  """Download a URL through the cache: a conditional GET only transfers the content when it changed.
+
+  When the server is unreachable or fails, or in offline mode, the last good copy is returned.
+  """
+  path = cache_path(url)
+  meta: dict = {}
+  if os.path.exists(f"{path}.json") and os.path.exists(path):
+    with open(f"{path}.json") as f:
+      meta = json.load(f)
+  if offline:
+    if not meta:
+      raise FileNotFoundError(f"{url} is not cached, it cannot be downloaded in offline mode")
+    return read_file(path)
+  headers = {}
+  if meta.get("etag"):
+    headers["If-None-Match"] = meta["etag"]
+  if meta.get("last_modified"):
+    headers["If-Modified-Since"] = meta["last_modified"]
+  try:
+    resp = get_client().get(url, headers=headers)
+    if resp.status_code == 304 and meta:
+      print(f"♻️ {url} not modified since {meta.get('last_modified') or time.ctime(meta['fetched'])}")
+      return read_file(path)
+    resp.raise_for_status()
+  except httpx.HTTPError as e:
+    if not meta:
+      raise
+    print(f"⚠️ Could not download {url} ({e!r}), using the copy of {time.ctime(meta['fetched'])}")
+    return read_file(path)
+  write_atomic(path, resp.content)
+  write_atomic(f"{path}.json", json.dumps({
+    "url": url,
+    "etag": resp.headers.get("etag"),
+    "last_modified": resp.headers.get("last-modified"),
+    "fetched": time.time(),
+  }).encode())
+  return resp.content
+
+def fetch_text(url: str) -> str:
+  return fetch(url).decode("utf-8")
+
+## documents harvested from the SPARQL endpoints, whose query results carry no validators
+def save_documents(key: str, docs: list["Document"]) -> None:
+  """Keep the documents of a loader, to reuse them while fresh or when the endpoint fails."""
+  content = json.dumps({
+    "fetched": time.time(),
+    "docs": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs],
+  }, default=str)
+  write_atomic(f"{cache_path(key)}.docs.json", content.encode())
+
+def load_documents(key: str, max_age: float | None = None) -> list["Document"] | None:
+  """Documents saved for the key, if they are younger than `max_age` seconds (any age if None)."""
+  from langchain_core.documents import Document
+  path = f"{cache_path(key)}.docs.json"
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    cached = json.load(f)
+  if max_age is not None and time.time() - cached["fetched"] > max_age:
+    return None
+  return [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in cached["docs"]]
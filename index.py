@@ -1,16 +1,36 @@
+import os
+import json
+import time
+import asyncio
+import uuid
+import shutil
 import httpx
-import pandas as pd
+import hashlib
+import argparse
+import itertools
+import threading
+import multiprocessing
+import numpy as np
 from langchain_core.documents import Document
-from langchain_community.document_loaders import CSVLoader
-from fastembed import TextEmbedding
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams
-from langchain_core.documents import Document
-from sparql_llm import SparqlExamplesLoader, SparqlVoidShapesLoader
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import TYPE_CHECKING
+from cache import LRUCache, normalize
+from tracing import span
+import httpcache
+
+# Heavy dependencies are imported where they are used, so that importing this module
+# from the apps does not load them before they are needed
+if TYPE_CHECKING:
+  from fastembed import TextEmbedding, SparseTextEmbedding
+  from qdrant_client import QdrantClient
+  from qdrant_client.models import Filter, QueryRequest, SparseVector, SearchParams
 
 ## general loader
 # def load_resources_csv(url: str) -> list[Document]:
 #   """Load resources from a CSV file and return a list of Document objects."""
+#   from langchain_community.document_loaders import CSVLoader
 #   resp = httpx.get(url, follow_redirects=True)
   
 #   with open("tmp.csv", "w") as f:
@@ -25,81 +45,930 @@ from sparql_llm import SparqlExamplesLoader, SparqlVoidShapesLoader
 
 ## custom loader for more accurate query matching
 def load_resources_csv(url: str) -> list[Document]:
-  """Load resources from a CSV file and return a list of Document objects."""
-  df = pd.read_csv(url)
+  """Load resources from a CSV file and return a list of Document objects.
+
+  Each resource gets a document with its long description, and the ontology terms of the
+  resource are indexed in a second document whose payload points to the first one with its
+  `resource` ID, instead of repeating the description (see `Retriever.collapse`).
+  """
+  import io
+  import pandas as pd
+  # Remote files go through the HTTP cache, only downloaded again when they changed
+  df = pd.read_csv(io.BytesIO(httpcache.fetch(url)) if url.startswith(("http://", "https://")) else url)
+  df = df.fillna("").astype(str)
+  descriptions = "[" + df["title"] + "](" + df["url"] + ") (" + df["category"] + "): " + df["description"]
+  page_contents = df["title"] + " " + df["description"]
+  terms = df["ontology_terms"].str.strip() if "ontology_terms" in df else pd.Series("", index=df.index)
   docs: list[Document] = []
-  for _, row in df.iterrows():
-    description = f"[{row['title']}]({row['url']}) ({row['category']}): {row['description']}"
-    page_content = f"{row['title']} {row['description']}"
+  for iri, page_content, description, ontology_terms in zip(df["url"], page_contents, descriptions, terms):
     # Long description of the resource
-    doc = Document(
+    resource = Document(
       page_content=page_content,
       metadata={
-        "iri": row["url"],
+        "iri": iri,
         "page_content": page_content,
         "description": description,
         "doc_type": "General information",
       }
     )
-    docs.append(doc)
+    docs.append(resource)
     # Ontology terms
-    if row.get("ontology_terms"):
-      page_content = f"{row['ontology_terms']}"
-      doc = Document(
-        page_content=page_content,
+    if ontology_terms:
+      docs.append(Document(
+        page_content=ontology_terms,
         metadata={
-          "iri": row["url"],
-          "page_content": page_content,
-          "description": description,
+          "iri": iri,
+          "page_content": ontology_terms,
+          "resource": doc_id(resource),
           "doc_type": "General information",
         }
-      )
-      docs.append(doc)
+      ))
   print(f"✅ {len(docs)} documents indexed from {url}")
   return docs
 
-def load_sparql_endpoints() -> list[Document]:
-  endpoints: list[str] = [
-    "https://sparql.uniprot.org/sparql/",
-    "https://www.bgee.org/sparql/",
-    "https://sparql.omabrowser.org/sparql/",
-    "https://sparql.rhea-db.org/sparql/",
-  ]
+def run_in_daemon_thread(func: Callable[[], list[Document]]) -> asyncio.Future:
+  """Run a blocking loader in a daemon thread, that the process does not wait for at exit if it hangs."""
+  loop = asyncio.get_running_loop()
+  future = loop.create_future()
+
+  def settle(set_result: Callable, value) -> None:
+    # The future is cancelled when the loader timed out
+    if not future.done():
+      set_result(value)
+
+  def run() -> None:
+    try:
+      outcome = (future.set_result, func())
+    except Exception as e:
+      outcome = (future.set_exception, e)
+    try:
+      loop.call_soon_threadsafe(settle, *outcome)
+    except RuntimeError:
+      # The harvest is over, the loop is closed
+      pass
+
+  threading.Thread(target=run, name="harvest", daemon=True).start()
+  return future
+
+async def harvest(
+  endpoint: str,
+  loader,
+  slots: asyncio.Semaphore,
+  timeout: float,
+  max_age: float = 0,
+) -> list[Document] | None:
+  """Run a sparql_llm loader in a thread, return None if the endpoint failed or timed out.
+
+  The documents harvested less than `max_age` seconds ago are reused without querying the endpoint,
+  and the last harvested ones are used when it fails, or in offline mode.
+  """
+  key = f"{loader.__name__} {endpoint}"
+  if (docs := httpcache.load_documents(key, None if httpcache.offline else max_age)) is not None:
+    print(f"  ♻️ {loader.__name__} reused {len(docs)} cached documents of {endpoint}")
+    return docs
+  if httpcache.offline:
+    print(f"  ❌ {loader.__name__} has no cached documents of {endpoint} in offline mode")
+    return None
+  async with slots:
+    start = time.perf_counter()
+    try:
+      docs = await asyncio.wait_for(run_in_daemon_thread(lambda: loader(endpoint).load()), timeout)
+    except Exception as e:
+      print(f"  ❌ {loader.__name__} failed for {endpoint} after {time.perf_counter() - start:.1f}s: {e!r}")
+      if (docs := httpcache.load_documents(key)) is not None:
+        print(f"  ♻️ {loader.__name__} uses the {len(docs)} documents of {endpoint} harvested previously")
+      return docs
+  print(f"  🔎 {loader.__name__} got {len(docs)} documents from {endpoint} in {time.perf_counter() - start:.1f}s")
+  httpcache.save_documents(key, docs)
+  return docs
+
+sparql_endpoints: list[str] = [
+  "https://sparql.uniprot.org/sparql/",
+  "https://www.bgee.org/sparql/",
+  "https://sparql.omabrowser.org/sparql/",
+  "https://sparql.rhea-db.org/sparql/",
+]
+
+def load_sparql_endpoints(
+  max_workers: int = 8,
+  timeout: float = 300,
+  max_age: float = 0,
+  endpoints: list[str] | None = None,
+  loaders: tuple | None = None,
+) -> tuple[list[Document], list[str]]:
+  """Harvest examples and VoID shapes of the endpoints concurrently, skipping the failing ones.
+  Documents harvested less than `max_age` seconds ago are reused.
+
+  The loaders run in daemon threads: one that hangs past its timeout is abandoned, and does not keep the process alive.
+  Returns the documents and the list of loaders that failed.
+  """
+  if loaders is None:
+    from sparql_llm import SparqlExamplesLoader, SparqlVoidShapesLoader
+    loaders = (SparqlExamplesLoader, SparqlVoidShapesLoader)
+  endpoints = endpoints or sparql_endpoints
+  tasks = [(endpoint, loader) for endpoint in endpoints for loader in loaders]
+
+  async def harvest_all() -> list[list[Document] | None]:
+    # The timeout of a loader starts when it gets a slot, not while it is queued
+    slots = asyncio.Semaphore(max_workers)
+    return await asyncio.gather(*(harvest(endpoint, loader, slots, timeout, max_age) for endpoint, loader in tasks))
+
+  results = asyncio.run(harvest_all())
+
   docs: list[Document] = []
-  for endpoint in endpoints:
-    print(f"\n  🔎 Getting metadata for {endpoint}")
-    docs += SparqlExamplesLoader(endpoint).load()
-    docs += SparqlVoidShapesLoader(endpoint).load()
+  for result in results:
+    docs += result or []
+  failed = sorted({f"{loader.__name__} {endpoint}" for (endpoint, loader), result in zip(tasks, results) if result is None})
   print(f"✅ {len(docs)} documents indexed from {len(endpoints)} endpoints")
-  return docs
+  if failed:
+    print(f"⚠️ Skipped {len(failed)} failed loaders: {', '.join(failed)}")
+  return docs, failed
 
-embedding_model = TextEmbedding(
-  "BAAI/bge-small-en-v1.5",
-  # providers=["CUDAExecutionProvider"], # To use GPUs, replace the fastembed dependency with fastembed-gpu
-)
+embedding_model_name = "BAAI/bge-small-en-v1.5"
 embedding_dimensions = 384 # Check the list of models to find a model dimensions
+# BM25 sparse vectors, to match the identifiers (P68871, TP53, ACE2...) that dense vectors miss
+sparse_model_name = "Qdrant/bm25"
+dense_vector_name = "dense"
+sparse_vector_name = "bm25"
+index_models = f"{embedding_model_name}+{sparse_model_name}"
 collection_name = "sib-biodata"
-vectordb = QdrantClient(path="data/vectordb")
+# Store of the index built in place by the previous versions, the builds now go to builds_path
+vectordb_path = "data/vectordb"
+# Each run of index.py writes a new build `sib-biodata-<timestamp>`, made live once validated: the
+# embedded store of a build is in its own directory, and on a server the served collection names are
+# aliases of the build collections. The manifest of each build is kept next to them, for rollbacks.
+builds_path = "data/vectordb-builds"
+# Set QDRANT_URL to share a Qdrant server between the app workers, instead of loading the embedded
+# store in the memory of each of them. Quantization, on-disk vectors and HNSW only apply to a server
+vectordb_url = os.environ.get("QDRANT_URL")
+# Flat export of the dense vectors of the index built in place, searched in-process by the numpy
+# retriever (see retriever.py). Each build is exported next to its store, see `flat_index_dir`
+flat_index_path = "data/vectordb-flat"
 
-if __name__ == "__main__":
-  docs = load_resources_csv("https://github.com/sib-swiss/sparql-llm/raw/refs/heads/main/src/expasy-agent/expasy_resources_metadata.csv")
-  docs += load_sparql_endpoints()
-  print(docs[0])
+## storage of the dense vectors
+def storage_config(
+  quantization: str | None = None,
+  on_disk: bool = False,
+  hnsw_m: int | None = None,
+  hnsw_ef_construct: int | None = None,
+) -> dict:
+  """Storage options of the dense vectors, as recorded in the manifest."""
+  if quantization not in (None, "scalar", "binary"):
+    raise ValueError(f"Unknown quantization: {quantization}")
+  return {"quantization": quantization, "on_disk": on_disk, "hnsw_m": hnsw_m, "hnsw_ef_construct": hnsw_ef_construct}
 
-  if vectordb.collection_exists(collection_name):
-    vectordb.delete_collection(collection_name)
-  
-  # Create the collection of embeddings
-  vectordb.create_collection(
-    collection_name=collection_name,
-    vectors_config=VectorParams(size=embedding_dimensions, distance=Distance.COSINE),
+def collection_config(storage: dict) -> dict:
+  """Arguments of `create_collection` for the storage options."""
+  from qdrant_client.models import (
+    Distance, VectorParams, SparseVectorParams, Modifier, HnswConfigDiff,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType, BinaryQuantization, BinaryQuantizationConfig,
   )
-  
-  # Generate embeddings for each document
-  embeddings = embedding_model.embed([q.page_content for q in docs])
-  # Upload the embeddings in the collection
-  vectordb.upload_collection(
-    collection_name=collection_name,
-    vectors=[embed.tolist() for embed in embeddings],
-    payload=[doc.metadata for doc in docs],
+  quantization_config = None
+  # The quantized vectors stay in RAM, the original ones are only read from disk to rescore
+  if storage.get("quantization") == "scalar":
+    quantization_config = ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True))
+  elif storage.get("quantization") == "binary":
+    quantization_config = BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+  return {
+    "vectors_config": {
+      dense_vector_name: VectorParams(size=embedding_dimensions, distance=Distance.COSINE, on_disk=storage.get("on_disk", False)),
+    },
+    "sparse_vectors_config": {sparse_vector_name: SparseVectorParams(modifier=Modifier.IDF)},
+    "hnsw_config": HnswConfigDiff(m=storage.get("hnsw_m"), ef_construct=storage.get("hnsw_ef_construct"), on_disk=storage.get("on_disk", False)),
+    "quantization_config": quantization_config,
+  }
+
+def search_params(storage: dict) -> "SearchParams | None":
+  """Search parameters for the storage options: rescore quantized results with the original vectors.
+
+  QDRANT_OVERSAMPLING (default 2.0) and QDRANT_HNSW_EF tune the accuracy / latency trade-off.
+  """
+  from qdrant_client.models import SearchParams, QuantizationSearchParams
+  hnsw_ef = int(os.environ["QDRANT_HNSW_EF"]) if os.environ.get("QDRANT_HNSW_EF") else None
+  if not storage.get("quantization") and hnsw_ef is None:
+    return None
+  quantization = QuantizationSearchParams(
+    rescore=True, oversampling=float(os.environ.get("QDRANT_OVERSAMPLING", 2.0))
+  ) if storage.get("quantization") else None
+  return SearchParams(hnsw_ef=hnsw_ef, quantization=quantization)
+
+## lazily constructed, so that only the processes using them pay for loading the model and opening the DB
+_embedding_model: "TextEmbedding | None" = None
+_sparse_model: "SparseTextEmbedding | None" = None
+_vectordb: "QdrantClient | None" = None
+_vectordb_path: str | None = None
+# Clients of the stores replaced by another build, closed after a grace period
+_retired_vectordbs: dict[str | None, tuple["QdrantClient", threading.Timer]] = {}
+retired_vectordb_delay = 60.0
+_init_lock = threading.Lock()
+
+def get_embedding_model() -> "TextEmbedding":
+  """Load the embedding model on first use and return the same instance afterwards."""
+  global _embedding_model
+  with _init_lock:
+    if _embedding_model is None:
+      from fastembed import TextEmbedding
+      _embedding_model = TextEmbedding(
+        embedding_model_name,
+        # providers=["CUDAExecutionProvider"], # To use GPUs, replace the fastembed dependency with fastembed-gpu
+      )
+  return _embedding_model
+
+def get_sparse_model() -> "SparseTextEmbedding":
+  """Load the sparse embedding model on first use and return the same instance afterwards."""
+  global _sparse_model
+  with _init_lock:
+    if _sparse_model is None:
+      from fastembed import SparseTextEmbedding
+      _sparse_model = SparseTextEmbedding(sparse_model_name)
+  return _sparse_model
+
+def get_vectordb() -> "QdrantClient":
+  """Open the vector database on first use and return the same client afterwards.
+
+  The embedded store is opened again when another build was made live (the server aliases switch by themselves).
+  """
+  global _vectordb, _vectordb_path
+  path = None if vectordb_url else manifest_info().get("path") or vectordb_path
+  with _init_lock:
+    if _vectordb is None or path != _vectordb_path:
+      from qdrant_client import QdrantClient
+      previous = (_vectordb_path, _vectordb)
+      if path in _retired_vectordbs:
+        # Rolled back before the client of the store was closed
+        _vectordb, timer = _retired_vectordbs.pop(path)
+        timer.cancel()
+      else:
+        _vectordb = QdrantClient(url=vectordb_url) if vectordb_url else QdrantClient(path=path)
+      if previous[1] is not None:
+        # The queries in flight finish with the previous client, it is closed later to release the lock of its store
+        timer = threading.Timer(retired_vectordb_delay, close_retired_vectordb, args=(previous[0],))
+        timer.daemon = True
+        _retired_vectordbs[previous[0]] = (previous[1], timer)
+        timer.start()
+      _vectordb_path = path
+  return _vectordb
+
+def close_retired_vectordb(path: str | None) -> None:
+  with _init_lock:
+    retired = _retired_vectordbs.pop(path, None)
+  if retired:
+    retired[0].close()
+
+manifest_path = "data/vectordb-manifest.json"
+
+def doc_id(doc: Document) -> str:
+  """Stable ID derived from the hash of the document content and metadata."""
+  content = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}, sort_keys=True, default=str)
+  return str(uuid.UUID(hashlib.sha256(content.encode()).hexdigest()[:32]))
+
+def load_manifest(path: str | None = None) -> dict:
+  """Load the manifest of the documents indexed in the live build, or in the build of another manifest."""
+  path = path or manifest_path
+  if not os.path.exists(path):
+    return {"model": None, "ids": []}
+  with open(path) as f:
+    return json.load(f)
+
+def write_manifest(manifest: dict, path: str) -> None:
+  """Replace a manifest atomically, the apps switch to the build of `manifest_path` when it changes."""
+  os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+  with open(f"{path}.tmp", "w") as f:
+    json.dump(manifest, f)
+  os.replace(f"{path}.tmp", path)
+
+def save_manifest(
+  ids: list[str],
+  partitioned: bool = False,
+  storage: dict | None = None,
+  build: str | None = None,
+  flat: bool = False,
+) -> dict:
+  """Save the manifest of a build in builds_path."""
+  ids = sorted(ids)
+  # The version changes whenever the indexed documents change, to invalidate the answers cached by the apps
+  version = hashlib.sha256(f"{index_models}:{','.join(ids)}".encode()).hexdigest()[:16]
+  manifest = {
+    "model": index_models,
+    "collection": collection_name,
+    "build": build,
+    # Store of the embedded build, opened by the apps
+    "path": None if vectordb_url else f"{builds_path}/{build}",
+    "partitioned": partitioned,
+    "storage": storage or storage_config(),
+    # The build has a flat export for the numpy retriever
+    "flat": flat,
+    "version": version,
+    "ids": ids,
+  }
+  write_manifest(manifest, f"{builds_path}/{build}.json")
+  return manifest
+
+_manifest_info: tuple[float, dict] = (0.0, {})
+
+def manifest_info() -> dict:
+  """Manifest without the list of IDs, re-read only when it was modified."""
+  global _manifest_info
+  if not os.path.exists(manifest_path):
+    return {}
+  mtime = os.path.getmtime(manifest_path)
+  if mtime != _manifest_info[0]:
+    _manifest_info = (mtime, {key: value for key, value in load_manifest().items() if key != "ids"})
+  return _manifest_info[1]
+
+def index_version() -> str | None:
+  """Version of the indexed documents."""
+  return manifest_info().get("version")
+
+## question embeddings cache, optionally persisted with EMBEDDING_CACHE_PATH=data/embeddings.sqlite
+question_cache = LRUCache(
+  maxsize=int(os.environ.get("EMBEDDING_CACHE_SIZE", 1024)),
+  path=os.environ.get("EMBEDDING_CACHE_PATH"),
+  table="question_embeddings",
+)
+
+def embed_questions(questions: list[str]) -> list[np.ndarray]:
+  """Embed questions at query time with a single call of the model, reusing the embeddings of previous identical questions."""
+  texts = [normalize(question) for question in questions]
+  embeddings = [question_cache.get(f"{embedding_model_name}:{text}") for text in texts]
+  missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+  if not missing:
+    return embeddings
+  with span("embed", questions=len(missing)):
+    new = dict(zip(missing, get_embedding_model().embed(missing, batch_size=len(missing))))
+  for text, embedding in new.items():
+    question_cache.put(f"{embedding_model_name}:{text}", embedding)
+  return [new[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+
+def embed_question(question: str) -> np.ndarray:
+  """Embed a question at query time, reusing the embedding of previous identical questions."""
+  return embed_questions([question])[0]
+
+def embed_sparse_question(question: str) -> "SparseVector":
+  """BM25 vector of a question at query time, cached like the dense embeddings."""
+  from qdrant_client.models import SparseVector
+  text = normalize(question)
+  key = f"{sparse_model_name}:{text}"
+  # Cached as a dict of lists, which the sqlite tier stores as JSON
+  vector = question_cache.get(key)
+  if vector is None:
+    embedding = next(iter(get_sparse_model().query_embed(text)))
+    vector = {"indices": embedding.indices.tolist(), "values": embedding.values.tolist()}
+    question_cache.put(key, vector)
+  return SparseVector(**vector)
+
+## search
+intents = ("general_information", "sparql_query")
+
+def doc_intent(metadata: dict) -> str:
+  """Intent for which a document is relevant."""
+  return "general_information" if metadata.get("doc_type") == "General information" else "sparql_query"
+
+def intent_filter(intent: str) -> "Filter":
+  """Build the Qdrant filter matching the documents relevant for the intent."""
+  from qdrant_client.models import FieldCondition, Filter, MatchValue
+  condition = FieldCondition(key="doc_type", match=MatchValue(value="General information"))
+  if intent == "general_information":
+    return Filter(must=[condition])
+  return Filter(must_not=[condition])
+
+def intent_collection(intent: str) -> str:
+  """Sub-collection holding only the documents relevant for the intent."""
+  return f"{collection_name}-{'general_information' if intent == 'general_information' else 'sparql_query'}"
+
+# Candidates of each search fused by the hybrid search, as a multiple of the number of results
+hybrid_prefetch_factor = int(os.environ.get("HYBRID_PREFETCH_FACTOR", 4))
+
+def query_request(
+  question: str,
+  query_filter: "Filter | None" = None,
+  limit: int = 10,
+  hybrid: bool = False,
+  dense: np.ndarray | None = None,
+) -> "QueryRequest":
+  """Query of a question: dense cosine search, or reciprocal rank fusion of the dense and BM25 searches.
+
+  `dense` is the embedding of the question when it was already computed, e.g. for a batch.
+  """
+  from qdrant_client.models import QueryRequest, Prefetch, FusionQuery, Fusion
+  dense = (embed_question(question) if dense is None else dense).tolist()
+  params = search_params(manifest_info().get("storage", {}))
+  if not hybrid:
+    return QueryRequest(query=dense, using=dense_vector_name, filter=query_filter, params=params, limit=limit, with_payload=True)
+  return QueryRequest(
+    prefetch=[
+      Prefetch(query=dense, using=dense_vector_name, filter=query_filter, params=params, limit=limit * hybrid_prefetch_factor),
+      Prefetch(query=embed_sparse_question(question), using=sparse_vector_name, filter=query_filter, limit=limit * hybrid_prefetch_factor),
+    ],
+    query=FusionQuery(fusion=Fusion.RRF),
+    limit=limit,
+    with_payload=True,
   )
+
+def search_batch(
+  queries: list[tuple[str, str | None]],
+  limit: int = 10,
+  hybrid: bool = False,
+  partitioned: bool | None = None,
+  embeddings: list[np.ndarray] | None = None,
+) -> list[list]:
+  """Search the documents of several (question, intent) queries, with one call per collection.
+
+  With an intent, the sub-collection of the intent is searched when the index is partitioned
+  (or `partitioned` is True), otherwise the main collection is searched with the intent filter.
+  The `embeddings` of the questions are computed when not given.
+  """
+  if partitioned is None:
+    partitioned = manifest_info().get("partitioned", False)
+  # Embed all the questions at once
+  if embeddings is None:
+    embeddings = embed_questions([question for question, _ in queries])
+  requests: dict[str, list[tuple[int, "QueryRequest"]]] = {}
+  for i, ((question, intent), embedding) in enumerate(zip(queries, embeddings)):
+    if intent and partitioned:
+      collection, query_filter = intent_collection(intent), None
+    else:
+      collection, query_filter = collection_name, intent_filter(intent) if intent else None
+    requests.setdefault(collection, []).append((i, query_request(question, query_filter, limit, hybrid, embedding)))
+  points: list[list] = [[] for _ in queries]
+  for collection, collection_requests in requests.items():
+    with span("query_points", collection=collection, queries=len(collection_requests), hybrid=hybrid):
+      results = get_vectordb().query_batch_points(
+        collection_name=collection,
+        requests=[request for _, request in collection_requests],
+      )
+    for (i, _), result in zip(collection_requests, results):
+      points[i] = result.points
+  return points
+
+def search(question: str, intent: str | None = None, limit: int = 10, hybrid: bool = False, partitioned: bool | None = None) -> list:
+  """Search the documents most similar to the question, relevant for the intent if given."""
+  return search_batch([(question, intent)], limit, hybrid, partitioned)[0]
+
+def get_records(ids: list[str]) -> dict[str, dict]:
+  """Payloads of the points of the main collection with these IDs."""
+  if not ids:
+    return {}
+  with span("retrieve_records", ids=len(ids)):
+    points = get_vectordb().retrieve(collection_name=collection_name, ids=ids, with_payload=True)
+  return {str(point.id): point.payload for point in points}
+
+## cheap local intent classifier, to skip the LLM extraction call when it is confident
+_intent_centroids: tuple[str | None, np.ndarray | None] = (None, None)
+
+def intent_centroids() -> np.ndarray:
+  """Normalized centroids of the "General information" and SPARQL documents embeddings."""
+  global _intent_centroids
+  version = index_version()
+  if _intent_centroids[1] is None or _intent_centroids[0] != version:
+    sums = np.zeros((2, embedding_dimensions))
+    offset = None
+    while True:
+      points, offset = get_vectordb().scroll(
+        collection_name=collection_name, limit=1024, offset=offset, with_payload=["doc_type"], with_vectors=[dense_vector_name]
+      )
+      for point in points:
+        sums[intents.index(doc_intent(point.payload))] += point.vector[dense_vector_name]
+      if offset is None:
+        break
+    _intent_centroids = (version, sums / np.linalg.norm(sums, axis=1, keepdims=True))
+  return _intent_centroids[1]
+
+def classify_intent(embedding: np.ndarray, centroids: np.ndarray | None = None) -> tuple[str, float]:
+  """Nearest-centroid intent of a question embedding, with the margin between the 2 similarities."""
+  centroids = intent_centroids() if centroids is None else centroids
+  general, sparql = centroids @ (embedding / np.linalg.norm(embedding))
+  return ("general_information" if general > sparql else "sparql_query"), float(abs(general - sparql))
+
+def embed_texts(texts: list[str]) -> np.ndarray:
+  """Embed a batch of texts with the embedding model of the current process."""
+  return np.stack(list(get_embedding_model().embed(texts, batch_size=len(texts))))
+
+def init_embedding_worker(threads: int) -> None:
+  """Load a model restricted to `threads` ONNX threads in each embedding worker process."""
+  from fastembed import TextEmbedding
+  global _embedding_model
+  _embedding_model = TextEmbedding(embedding_model_name, threads=threads)
+
+def worker_threads(parallel: int) -> int:
+  """ONNX threads of each of `parallel` embedding workers, sharing the cores between them."""
+  return max(1, (os.cpu_count() or 1) // parallel)
+
+def embed_batches(batches: Iterable[list[str]], parallel: int = 1, threads: int | None = None) -> Iterator[np.ndarray]:
+  """Embed batches of texts, in order, spreading them across `parallel` worker processes of
+  `threads` ONNX threads each (by default the cores are shared between the workers)."""
+  threads = threads or worker_threads(parallel)
+  if parallel <= 1:
+    for texts in batches:
+      yield embed_texts(texts)
+    return
+  with ProcessPoolExecutor(
+    max_workers=parallel,
+    mp_context=multiprocessing.get_context("spawn"),
+    initializer=init_embedding_worker,
+    initargs=(threads,),
+  ) as pool:
+    # Keep every worker busy, without reading the whole stream of batches ahead
+    pending: deque = deque()
+    for texts in batches:
+      pending.append(pool.submit(embed_texts, texts))
+      if len(pending) >= 2 * parallel:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+def upload_batch(docs: dict[str, Document], embeddings: np.ndarray, vectordb: "QdrantClient", targets: dict[str, str]) -> None:
+  """Compute the BM25 vectors of the documents and upload them with their dense embeddings to the
+  collections of a build (`targets` maps the served names to the build ones), also in the
+  sub-collection of their intent when the index is partitioned."""
+  from qdrant_client.models import SparseVector, PointVectors
+  ids = list(docs)
+  sparse_vectors = [
+    SparseVector(indices=sparse.indices.tolist(), values=sparse.values.tolist())
+    for sparse in get_sparse_model().embed([doc.page_content for doc in docs.values()])
+  ]
+  groups = {collection_name: np.arange(len(ids))}
+  for intent in intents:
+    if intent_collection(intent) in targets:
+      groups[intent_collection(intent)] = np.array(
+        [i for i, doc in enumerate(docs.values()) if doc_intent(doc.metadata) == intent], dtype=int
+      )
+  for collection, rows in groups.items():
+    if len(rows):
+      # The dense vectors are uploaded as a numpy batch, the BM25 vectors are then added to the points
+      vectordb.upload_collection(
+        collection_name=targets[collection],
+        vectors={dense_vector_name: embeddings[rows]},
+        payload=[docs[ids[i]].metadata for i in rows],
+        ids=[ids[i] for i in rows],
+        wait=True,
+      )
+      vectordb.update_vectors(
+        collection_name=targets[collection],
+        points=[PointVectors(id=ids[i], vector={sparse_vector_name: sparse_vectors[i]}) for i in rows],
+      )
+
+## versioned builds
+def build_collection(build: str, collection: str = collection_name) -> str:
+  """Name of a collection in a build: versioned on a server, unchanged in the embedded store of the build."""
+  return collection.replace(collection_name, build, 1) if vectordb_url else collection
+
+def flat_index_dir(build: str | None = None) -> str:
+  """Flat export of a build, by default of the live build."""
+  build = build or manifest_info().get("build")
+  return f"{builds_path}/{build}-flat" if build else flat_index_path
+
+def list_builds() -> list[str]:
+  """Builds with a manifest in builds_path, oldest first."""
+  if not os.path.exists(builds_path):
+    return []
+  return sorted(name.removesuffix(".json") for name in os.listdir(builds_path) if name.endswith(".json"))
+
+def open_build(build: str, copy_from: str | None = None) -> "QdrantClient":
+  """Client writing the collections of a build, on the server or in the embedded store of the build.
+
+  A new embedded store starts as a copy of the `copy_from` store, the live one that the apps keep serving.
+  """
+  from qdrant_client import QdrantClient
+  if vectordb_url:
+    return QdrantClient(url=vectordb_url)
+  path = f"{builds_path}/{build}"
+  if copy_from and os.path.exists(copy_from) and not os.path.exists(path):
+    shutil.copytree(copy_from, path, ignore=shutil.ignore_patterns(".lock"))
+  return QdrantClient(path=path)
+
+def copy_collection(vectordb: "QdrantClient", source: str, target: str) -> None:
+  """Copy the points of a server collection with their vectors, to update them in a new build without embedding them again."""
+  from qdrant_client.models import PointStruct
+  offset = None
+  while True:
+    points, offset = vectordb.scroll(collection_name=source, limit=1024, offset=offset, with_payload=True, with_vectors=True)
+    if points:
+      vectordb.upsert(collection_name=target, points=[
+        PointStruct(id=point.id, vector=point.vector, payload=point.payload) for point in points
+      ])
+    if offset is None:
+      break
+
+def validate_build(vectordb: "QdrantClient", manifest: dict, min_documents: int = 1) -> None:
+  """Check that a build can be served before it goes live, raise a ValueError otherwise."""
+  build, ids = manifest["build"], manifest["ids"]
+  if len(ids) < min_documents:
+    raise ValueError(f"{build} has {len(ids)} documents, at least {min_documents} expected")
+  count = vectordb.count(build_collection(build), exact=True).count
+  if count != len(ids):
+    raise ValueError(f"{build} has {count} points, {len(ids)} documents in its manifest")
+  if manifest["partitioned"]:
+    counts = sum(vectordb.count(build_collection(build, intent_collection(intent)), exact=True).count for intent in intents)
+    if counts != count:
+      raise ValueError(f"{build} has {counts} points in its intent sub-collections, {count} in the collection")
+  # A document must be found by its own vector
+  point = vectordb.retrieve(build_collection(build), ids=[ids[0]], with_vectors=[dense_vector_name])[0]
+  hits = vectordb.query_points(build_collection(build), query=point.vector[dense_vector_name], using=dense_vector_name, limit=5).points
+  if ids[0] not in {str(hit.id) for hit in hits}:
+    raise ValueError(f"{build} does not find its document {ids[0]}")
+
+def publish(build: str) -> None:
+  """Make a build live: switch the aliases of the server collections, then the manifest read by the apps."""
+  manifest = load_manifest(f"{builds_path}/{build}.json")
+  if vectordb_url:
+    from qdrant_client.models import CreateAlias, CreateAliasOperation, DeleteAlias, DeleteAliasOperation
+    vectordb = get_vectordb()
+    aliases = {alias.alias_name for alias in vectordb.get_aliases().aliases}
+    operations: list = []
+    for collection in [collection_name] + [intent_collection(intent) for intent in intents]:
+      if collection in aliases:
+        operations.append(DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=collection)))
+      elif vectordb.collection_exists(collection):
+        # Collection of an index built in place, replaced by an alias once
+        print(f"⚠️ Deleting the collection {collection} built in place, to replace it by an alias")
+        vectordb.delete_collection(collection)
+      if collection == collection_name or manifest["partitioned"]:
+        operations.append(CreateAliasOperation(
+          create_alias=CreateAlias(collection_name=build_collection(build, collection), alias_name=collection)
+        ))
+    # All the aliases switch in one atomic operation
+    vectordb.update_collection_aliases(change_aliases_operations=operations)
+  write_manifest(manifest, manifest_path)
+  print(f"🚀 {build} is live ({len(manifest['ids'])} documents)")
+
+def delete_build(build: str) -> None:
+  """Delete the collections or the store of a build, and its manifest."""
+  if vectordb_url:
+    vectordb = get_vectordb()
+    for collection in [collection_name] + [intent_collection(intent) for intent in intents]:
+      if vectordb.collection_exists(build_collection(build, collection)):
+        vectordb.delete_collection(build_collection(build, collection))
+  else:
+    shutil.rmtree(f"{builds_path}/{build}", ignore_errors=True)
+  shutil.rmtree(flat_index_dir(build), ignore_errors=True)
+  if os.path.exists(f"{builds_path}/{build}.json"):
+    os.remove(f"{builds_path}/{build}.json")
+
+def prune_builds(keep: int = 3) -> None:
+  """Delete the builds older than the last `keep` ones, except the live one."""
+  live = manifest_info().get("build")
+  for build in list_builds()[:-keep] if keep > 0 else []:
+    if build != live:
+      delete_build(build)
+      print(f"🗑️ {build} deleted")
+
+def rollback(build: str | None = None) -> None:
+  """Make a kept build live again, by default the one before the live build.
+
+  It is not validated again, it was when it was built.
+  """
+  builds = list_builds()
+  live = manifest_info().get("build")
+  if build is None:
+    previous = [name for name in builds if live is None or name < live]
+    if not previous:
+      raise ValueError(f"No build before {live} to roll back to")
+    build = previous[-1]
+  elif build not in builds:
+    raise ValueError(f"Unknown build {build}, kept builds: {', '.join(builds)}")
+  publish(build)
+
+def sync_collection(
+  docs: Iterable[Document],
+  rebuild: bool = False,
+  delete_removed: bool = True,
+  batch_size: int = 256,
+  parallel: int = 1,
+  threads: int | None = None,
+  partition: bool = False,
+  storage: dict | None = None,
+  flat: bool = False,
+  keep: int = 3,
+  min_ratio: float = 0.5,
+) -> str:
+  """Write a new build of the index and make it live once validated, returns the live build.
+
+  The build starts as a copy of the live one, where the new documents are embedded and uploaded and
+  the ones that disappeared since the last run are deleted, while the apps keep serving the live build.
+  Documents are consumed as a stream and embedded by batches of `batch_size`, on `parallel`
+  worker processes of `threads` ONNX threads, while the previous batches are uploaded in the background, so that memory
+  does not grow with the corpus.
+  When `docs` is a list and the documents, models and storage options did not change, the live
+  build is kept without writing a new one.
+  Set `delete_removed` to False when some sources failed, to keep their previously indexed documents.
+  With `partition`, the documents are also stored in one sub-collection per intent, searched without filter.
+  `storage` sets the quantization, on-disk and HNSW options of the dense vectors (see `storage_config`).
+  With `flat`, or when the live build has a flat export, the build is also exported for the numpy
+  retriever (see `export_flat_index`).
+  A build with less than `min_ratio` of the documents of the live one is not made live, and only
+  the last `keep` builds are kept for rollbacks.
+  """
+  from qdrant_client.http.models import PointIdsList, PayloadSchemaType
+  storage = storage or storage_config()
+  live = load_manifest()
+  # Keep exporting the builds once the live one has a flat export, the numpy retrievers follow the live build
+  flat = flat or live.get("flat", False) or (
+    live.get("build") is not None and os.path.exists(f"{flat_index_dir(live['build'])}/index.json")
+  )
+  build = f"{collection_name}-{time.strftime('%Y%m%d-%H%M%S')}"
+  reuse = (
+    not rebuild
+    and live["model"] == index_models
+    and live.get("partitioned", False) == partition
+    and live.get("storage", storage_config()) == storage
+  )
+  # With the documents in memory, a run that would not change them returns before writing a build
+  if reuse and live.get("build") is not None and isinstance(docs, Sequence):
+    ids = {doc_id(doc) for doc in docs}
+    live_ids = set(live["ids"])
+    exported = not flat or os.path.exists(f"{flat_index_dir(live['build'])}/index.json")
+    if exported and (ids == live_ids or (not delete_removed and ids <= live_ids)):
+      print(f"✅ The live build {live['build']} is up to date")
+      if not delete_removed:
+        print("⚠️ Some sources failed, documents missing from this run were kept in the index")
+      return live["build"]
+  vectordb = open_build(build, (live.get("path") or vectordb_path) if reuse else None)
+  collections = [collection_name] + ([intent_collection(intent) for intent in intents] if partition else [])
+  # Served collection name -> collection of the build
+  targets = {collection: build_collection(build, collection) for collection in collections}
+  # The live collections on a server, the copy of the live store otherwise
+  reuse = reuse and all(vectordb.collection_exists(collection) for collection in collections)
+  if vectordb_url or not reuse:
+    for collection, target in targets.items():
+      if vectordb.collection_exists(target):
+        vectordb.delete_collection(target)
+      # Create the collections of dense embeddings and BM25 sparse vectors
+      vectordb.create_collection(collection_name=target, **collection_config(storage))
+      if reuse:
+        copy_collection(vectordb, collection, target)
+    # Index the filtered fields, so that Qdrant server filters during the HNSW search (no effect in local mode)
+    for target in targets.values():
+      for field in ("doc_type", "endpoint_url"):
+        vectordb.create_payload_index(target, field_name=field, field_schema=PayloadSchemaType.KEYWORD)
+
+  previous = set(live["ids"]) if reuse else set()
+  indexed = set(previous)
+  seen: set[str] = set()
+  queued: deque[dict[str, Document]] = deque()
+
+  def new_batches() -> Iterator[list[str]]:
+    """Yield the texts of the documents not indexed yet, by batches of `batch_size`."""
+    for batch in itertools.batched(docs, batch_size):
+      new_docs: dict[str, Document] = {}
+      for doc in batch:
+        id = doc_id(doc)
+        seen.add(id)
+        if id not in indexed:
+          new_docs[id] = doc
+      if new_docs:
+        indexed.update(new_docs)
+        queued.append(new_docs)
+        yield [doc.page_content for doc in new_docs.values()]
+
+  try:
+    added = 0
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload") as uploader:
+      uploads: deque = deque()
+      # Generate embeddings for the new documents
+      for embeddings in embed_batches(new_batches(), parallel, threads):
+        new_docs = queued.popleft()
+        added += len(new_docs)
+        # Compute the BM25 vectors and upload while the next batch is embedded, keeping at most 2 batches in flight
+        if len(uploads) >= 2:
+          uploads.popleft().result()
+        uploads.append(uploader.submit(upload_batch, new_docs, embeddings, vectordb, targets))
+      for upload in uploads:
+        upload.result()
+
+    removed_ids = list(previous - seen) if delete_removed else []
+    if removed_ids:
+      for target in targets.values():
+        vectordb.delete(collection_name=target, points_selector=PointIdsList(points=removed_ids))
+    manifest = save_manifest(list(indexed - set(removed_ids)), partition, storage, build, flat)
+    print(f"✅ {added} documents added, {len(removed_ids)} removed, {len(seen) - added} unchanged in {build}")
+    if not delete_removed:
+      print("⚠️ Some sources failed, documents missing from this run were kept in the index")
+    # Nothing to publish when the documents did not change
+    unchanged = reuse and live.get("build") is not None and manifest["version"] == live["version"]
+    if unchanged:
+      print(f"✅ The live build {live['build']} is up to date")
+    else:
+      validate_build(vectordb, manifest, max(1, int(min_ratio * len(live["ids"]))))
+    if flat and not (unchanged and os.path.exists(f"{flat_index_dir(live['build'])}/index.json")):
+      export_flat_index(flat_index_dir(live["build"] if unchanged else build), vectordb, targets[collection_name], manifest["version"])
+  except Exception as e:
+    print(f"❌ {build} was not made live, the apps keep serving {live.get('build') or 'the previous index'}: {e!r}")
+    vectordb.close()
+    delete_build(build)
+    raise
+  # Release the embedded store before the apps open it
+  vectordb.close()
+  if unchanged:
+    delete_build(build)
+    return live["build"]
+  publish(build)
+  prune_builds(keep)
+  return build
+
+def export_flat_index(
+  path: str | None = None,
+  vectordb: "QdrantClient | None" = None,
+  collection: str = collection_name,
+  version: str | None = None,
+) -> None:
+  """Export the dense vectors of the collection as a normalized float32 matrix, with the payloads
+  and a boolean mask of the documents of each intent, for the numpy retriever.
+
+  By default the live collection is exported to the directory of the live build, `sync_collection`
+  exports a build before it goes live.
+  """
+  path = path or flat_index_dir()
+  vectordb = vectordb or get_vectordb()
+  ids: list[str] = []
+  payloads: list[dict] = []
+  vectors: list[list[float]] = []
+  offset = None
+  while True:
+    points, offset = vectordb.scroll(
+      collection_name=collection, limit=1024, offset=offset, with_payload=True, with_vectors=[dense_vector_name]
+    )
+    for point in points:
+      ids.append(str(point.id))
+      payloads.append(point.payload)
+      vectors.append(point.vector[dense_vector_name])
+    if offset is None:
+      break
+  matrix = np.array(vectors, dtype=np.float32).reshape(-1, embedding_dimensions)
+  matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+  masks = np.array([[doc_intent(payload) == intent for payload in payloads] for intent in intents], dtype=bool)
+  os.makedirs(path, exist_ok=True)
+  # Replace each file atomically, the index file last as the retrievers reload when it changes
+  for name, array in (("vectors", matrix), ("masks", masks.reshape(len(intents), -1))):
+    np.save(f"{path}/{name}.tmp.npy", array)
+    os.replace(f"{path}/{name}.tmp.npy", f"{path}/{name}.npy")
+  with open(f"{path}/index.json.tmp", "w") as f:
+    json.dump({"version": version or index_version(), "ids": ids, "payloads": payloads}, f)
+  os.replace(f"{path}/index.json.tmp", f"{path}/index.json")
+  print(f"✅ {len(ids)} vectors exported to {path} ({matrix.nbytes / 2**20:.1f} MB)")
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description="""
+    - run: uv run index.py
+    - help: uv run index.py --help
+    """,
+    formatter_class = argparse.RawDescriptionHelpFormatter
+  )
+  parser.add_argument("--rebuild", action = "store_true",
+                      help = "re-embed all documents in the new build instead of starting from a copy of the live one")
+  parser.add_argument("--workers", type = int, default = 8,
+                      help = "number of SPARQL endpoint loaders running concurrently")
+  parser.add_argument("--timeout", type = float, default = 300,
+                      help = "timeout in seconds of each SPARQL endpoint loader")
+  parser.add_argument("--batch-size", type = int, default = 256,
+                      help = "number of documents embedded and uploaded at once")
+  parser.add_argument("--parallel", type = int, default = 1,
+                      help = "number of worker processes computing embeddings (0 for one per core)")
+  parser.add_argument("--threads", type = int,
+                      help = "number of ONNX threads of each embedding worker (default: the cores shared between the workers)")
+  parser.add_argument("--partition", action = "store_true",
+                      help = "also store the documents in one sub-collection per intent, to search them without filter")
+  parser.add_argument("--quantization", choices = ["scalar", "binary"],
+                      help = "quantize the dense vectors kept in RAM, search results are rescored with the original vectors")
+  parser.add_argument("--on-disk", action = "store_true",
+                      help = "keep the original dense vectors and the HNSW graph on disk (mmap)")
+  parser.add_argument("--hnsw-m", type = int,
+                      help = "number of edges per node of the HNSW graph")
+  parser.add_argument("--hnsw-ef-construct", type = int,
+                      help = "number of neighbours considered while building the HNSW graph")
+  parser.add_argument("--flat", action = "store_true",
+                      help = "also export the dense vectors as a flat matrix for the numpy retriever (RETRIEVER=numpy)")
+  parser.add_argument("--max-age", type = float, default = 86400,
+                      help = "reuse the documents harvested from a SPARQL endpoint less than this number of seconds ago (0 to harvest again)")
+  parser.add_argument("--offline", action = "store_true",
+                      help = "do not download anything, index the last downloaded and harvested copies")
+  parser.add_argument("--keep", type = int, default = 3,
+                      help = "number of builds kept for rollbacks")
+  parser.add_argument("--min-ratio", type = float, default = 0.5,
+                      help = "do not make a build live with less than this ratio of the documents of the live build")
+  parser.add_argument("--rollback", nargs = "?", const = "", metavar = "BUILD",
+                      help = "make a kept build live again, by default the one before the live build, without indexing")
+  args = parser.parse_args()
+  httpcache.offline = httpcache.offline or args.offline
+
+  if args.rollback is not None:
+    rollback(args.rollback or None)
+  else:
+    csv_docs = load_resources_csv("https://github.com/sib-swiss/sparql-llm/raw/refs/heads/main/src/expasy-agent/expasy_resources_metadata.csv")
+    sparql_docs, failed = load_sparql_endpoints(args.workers, args.timeout, args.max_age)
+    print(csv_docs[0])
+
+    sync_collection(
+      csv_docs + sparql_docs,
+      rebuild=args.rebuild,
+      delete_removed=not failed,
+      batch_size=args.batch_size,
+      parallel=args.parallel or os.cpu_count(),
+      threads=args.threads,
+      partition=args.partition,
+      storage=storage_config(args.quantization, args.on_disk, args.hnsw_m, args.hnsw_ef_construct),
+      flat=args.flat,
+      keep=args.keep,
+      min_ratio=args.min_ratio,
+    )
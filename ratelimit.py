@@ -0,0 +1,206 @@
+import os
+import time
+import random
+import asyncio
+import weakref
+from langchain_core.language_models import BaseChatModel
+from tracing import add_collector, span
+
+## default budgets per provider: (requests/minute, tokens/minute), None means unlimited
+# Override with e.g. RATE_LIMIT_MISTRAL_RPM=120 RATE_LIMIT_MISTRAL_TPM=1000000
+PROVIDER_LIMITS: dict[str, tuple[int | None, int | None]] = {
+  "mistral": (60, 500_000),
+  "google": (15, 1_000_000),
+  "ollama": (None, None),
+}
+
+class TokenBucket:
+  """Bucket refilled continuously up to `capacity` units per minute."""
+  def __init__(self, per_minute: int | None):
+    self.capacity = per_minute
+    self.level = float(per_minute or 0)
+    self.updated = time.monotonic()
+
+  def _refill(self) -> None:
+    now = time.monotonic()
+    self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+    self.updated = now
+
+  def delay(self, amount: float) -> float:
+    """Seconds to wait before `amount` units are available."""
+    if self.capacity is None:
+      return 0.0
+    self._refill()
+    amount = min(amount, self.capacity)
+    return max(0.0, (amount - self.level) * 60 / self.capacity)
+
+  def take(self, amount: float) -> None:
+    """Consume `amount` units, the level may go negative to pay back an underestimate."""
+    if self.capacity is not None:
+      self._refill()
+      self.level -= amount
+
+class RateLimiter:
+  """Async rate limiter with request/minute and token/minute budgets.
+
+  Callers are served in arrival order: the lock is held while waiting for the
+  budget, so a large request cannot be starved by a flow of small ones.
+  """
+  def __init__(self, name: str, requests_per_minute: int | None, tokens_per_minute: int | None):
+    self.name = name
+    self.requests = TokenBucket(requests_per_minute)
+    self.tokens = TokenBucket(tokens_per_minute)
+    # The budgets are shared, but an asyncio lock is bound to the event loop using it
+    self._locks: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock] = weakref.WeakKeyDictionary()
+    self.queue_depth = 0
+    self.calls = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+
+  async def acquire(self, tokens: int) -> float:
+    """Wait until 1 request and `tokens` tokens are available, return the time waited."""
+    start = time.monotonic()
+    self.queue_depth += 1
+    try:
+      async with self._locks.setdefault(asyncio.get_running_loop(), asyncio.Lock()):
+        while (delay := max(self.requests.delay(1), self.tokens.delay(tokens))) > 0:
+          await asyncio.sleep(delay)
+        self.requests.take(1)
+        self.tokens.take(tokens)
+    finally:
+      self.queue_depth -= 1
+    waited = time.monotonic() - start
+    self.calls += 1
+    self.total_wait += waited
+    self.max_wait = max(self.max_wait, waited)
+    return waited
+
+  def record_usage(self, estimated: int, actual: int) -> None:
+    """Correct the token budget once the actual usage of a call is known."""
+    self.tokens.take(actual - estimated)
+
+  def stats(self) -> dict:
+    return {
+      "provider": self.name,
+      "queue_depth": self.queue_depth,
+      "calls": self.calls,
+      "avg_wait": self.total_wait / self.calls if self.calls else 0.0,
+      "max_wait": self.max_wait,
+    }
+
+limiters: dict[str, RateLimiter] = {}
+
+def limiter_metrics() -> list[tuple[str, dict[str, str], float]]:
+  """Stats of the limiters, served at /metrics by app7 with TRACING=prometheus."""
+  return [
+    (f"rate_limit_{key}", {"provider": name}, value)
+    for name, limiter in list(limiters.items())
+    for key, value in limiter.stats().items() if key != "provider"
+  ]
+add_collector(limiter_metrics)
+
+def get_limiter(provider: str) -> RateLimiter:
+  """Return the limiter shared by all models of the provider in this process."""
+  if provider not in limiters:
+    rpm, tpm = PROVIDER_LIMITS.get(provider, (None, None))
+    rpm = int(os.environ.get(f"RATE_LIMIT_{provider.upper()}_RPM", rpm or 0)) or None
+    tpm = int(os.environ.get(f"RATE_LIMIT_{provider.upper()}_TPM", tpm or 0)) or None
+    limiters[provider] = RateLimiter(provider, rpm, tpm)
+  return limiters[provider]
+
+def estimate_tokens(messages: list) -> int:
+  """Rough token count of the messages (~4 characters per token)."""
+  chars = 0
+  for message in messages:
+    if isinstance(message, dict):
+      chars += len(str(message.get("content", "")))
+    elif isinstance(message, tuple):
+      chars += len(str(message[1]))
+    else:
+      chars += len(str(getattr(message, "content", message)))
+  return chars // 4 + 1
+
+def is_rate_limited(error: Exception) -> bool:
+  """Check if the error is a HTTP 429 returned by the provider."""
+  status = getattr(getattr(error, "response", None), "status_code", None) or getattr(error, "code", None)
+  return status == 429 or "429" in str(error) or "rate limit" in str(error).lower()
+
+class RateLimitedChatModel:
+  """Wrap a chat model so that its async calls go through the provider rate limiter.
+
+  Calls failing with a 429 are retried with exponential backoff and jitter.
+  """
+  def __init__(self, model: BaseChatModel, limiter: RateLimiter, max_retries: int = 5, backoff: float = 1.0):
+    self.model = model
+    self.limiter = limiter
+    self.max_retries = max_retries
+    self.backoff = backoff
+
+  def __getattr__(self, name: str):
+    return getattr(self.model, name)
+
+  def with_structured_output(self, schema, **kwargs) -> "RateLimitedChatModel":
+    return RateLimitedChatModel(
+      self.model.with_structured_output(schema, **kwargs), self.limiter, self.max_retries, self.backoff
+    )
+
+  async def _acquire(self, estimated: int) -> None:
+    # The waits are traced instead of printed, and summed in the limiter stats at /metrics
+    with span("rate_limit", provider=self.limiter.name) as current:
+      waited = await self.limiter.acquire(estimated)
+      current.set(waited_s=round(waited, 4), queued=self.limiter.queue_depth)
+
+  async def _retry(self, attempt: int, error: Exception) -> None:
+    if attempt >= self.max_retries or not is_rate_limited(error):
+      raise error
+    delay = self.backoff * 2 ** attempt * (1 + random.random())
+    print(f"⚠️ {self.limiter.name} returned 429, retrying in {delay:.1f}s")
+    await asyncio.sleep(delay)
+
+  def _record(self, estimated: int, resp) -> None:
+    usage = getattr(resp, "usage_metadata", None)
+    if usage:
+      self.limiter.record_usage(estimated, usage["total_tokens"])
+
+  def _record_stream(self, estimated: int, total: int | None) -> None:
+    if total is not None:
+      self.limiter.record_usage(estimated, total)
+
+  async def ainvoke(self, messages: list, **kwargs):
+    estimated = estimate_tokens(messages)
+    for attempt in range(self.max_retries + 1):
+      await self._acquire(estimated)
+      try:
+        resp = await self.model.ainvoke(messages, **kwargs)
+      except Exception as e:
+        await self._retry(attempt, e)
+        continue
+      self._record(estimated, resp)
+      return resp
+
+  async def astream(self, messages: list, **kwargs):
+    estimated = estimate_tokens(messages)
+    for attempt in range(self.max_retries + 1):
+      await self._acquire(estimated)
+      started = False
+      # Streamed chunks carry usage deltas (some providers on every chunk), recorded once at the end
+      total: int | None = None
+      try:
+        async for resp in self.model.astream(messages, **kwargs):
+          started = True
+          if usage := getattr(resp, "usage_metadata", None):
+            total = (total or 0) + usage["total_tokens"]
+          yield resp
+        return
+      except Exception as e:
+        # Once tokens have been streamed to the user the call cannot be replayed
+        if started:
+          raise
+        await self._retry(attempt, e)
+      finally:
+        if started:
+          self._record_stream(estimated, total)
+
+def rate_limited(model: BaseChatModel, provider: str) -> RateLimitedChatModel:
+  """Wrap a model returned by `load_chat_model` with the shared limiter of its provider."""
+  return RateLimitedChatModel(model, get_limiter(provider))
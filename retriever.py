@@ -0,0 +1,246 @@
+import os
+import json
+import threading
+import numpy as np
+from abc import ABC, abstractmethod
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from tracing import span
+from index import (
+  search_batch, intent_centroids, embed_questions, intents,
+  manifest_info, get_vectordb, get_records, flat_index_dir,
+)
+
+@dataclass
+class Hit:
+  """Retrieved document, with the same fields as the points returned by Qdrant."""
+  id: str
+  score: float
+  payload: dict
+
+class Retriever(ABC):
+  """Search backend used by the apps: returns the documents of (question, intent) queries, best first.
+
+  The returned points have an `id`, a `score` and a `payload`.
+  The backends search `overfetch` times more documents than requested, to still return
+  `limit` documents once the hits of the same resource are collapsed.
+  """
+  overfetch = 2
+
+  @abstractmethod
+  def search_batch(
+    self,
+    queries: list[tuple[str, str | None]],
+    limit: int = 10,
+    hybrid: bool = False,
+    embeddings: list[np.ndarray] | None = None,
+  ) -> list[list]:
+    """Search the documents of several (question, intent) queries, with the `embeddings` of the
+    questions when they were already computed."""
+
+  def search(self, question: str, intent: str | None = None, limit: int = 10, hybrid: bool = False) -> list:
+    """Search the documents most similar to the question, relevant for the intent if given."""
+    return self.search_batch([(question, intent)], limit, hybrid)[0]
+
+  @abstractmethod
+  def intent_centroids(self) -> np.ndarray:
+    """Normalized centroids of the documents embeddings of each intent, for `classify_intent`."""
+
+  @abstractmethod
+  def records(self, ids: list[str]) -> dict[str, dict]:
+    """Payloads of the documents with these IDs."""
+
+  def collapse(
+    self,
+    results: list[list],
+    limit: int,
+    records: Callable[[list[str]], dict[str, dict]] | None = None,
+  ) -> list[list]:
+    """Keep the best hit of each resource, so that its description fills a single context slot,
+    and the best `limit` hits of each query.
+
+    The ontology terms documents only point to their resource with the `resource` ID of their
+    payload: their hits take the ID and payload of the resource, read with `records` when the
+    resource itself was not hit (or the given `records` function).
+    """
+    missing = {
+      point.payload["resource"] for points in results for point in points
+      if point.payload.get("resource") and not any(str(hit.id) == point.payload["resource"] for hit in points)
+    }
+    found = (records or self.records)(sorted(missing)) if missing else {}
+    collapsed: list[list] = []
+    for points in results:
+      payloads = {str(point.id): point.payload for point in points} | found
+      seen: set[str] = set()
+      kept: list = []
+      for point in points:
+        resource = point.payload.get("resource")
+        key = resource or str(point.id)
+        if key in seen:
+          continue
+        seen.add(key)
+        if resource:
+          if resource in payloads:
+            point = Hit(resource, point.score, payloads[resource])
+          else:
+            print(f"⚠️ Resource {resource} of the document {point.id} not found, is the index complete?")
+        kept.append(point)
+        if len(kept) == limit:
+          break
+      collapsed.append(kept)
+    return collapsed
+
+  def warm(self) -> None:
+    """Open the index before the first question."""
+
+class QdrantRetriever(Retriever):
+  """Search the Qdrant collection, or its per-intent sub-collections when the index is partitioned."""
+  def __init__(self, partitioned: bool | None = None):
+    self.partitioned = partitioned
+
+  def search_batch(
+    self,
+    queries: list[tuple[str, str | None]],
+    limit: int = 10,
+    hybrid: bool = False,
+    embeddings: list[np.ndarray] | None = None,
+  ) -> list[list]:
+    return self.collapse(search_batch(queries, limit * self.overfetch, hybrid, self.partitioned, embeddings), limit)
+
+  def intent_centroids(self) -> np.ndarray:
+    return intent_centroids()
+
+  def records(self, ids: list[str]) -> dict[str, dict]:
+    return get_records(ids)
+
+  def warm(self) -> None:
+    get_vectordb()
+
+@dataclass
+class FlatIndex:
+  """Snapshot of a flat export, searched as a whole while another one may be loaded."""
+  path: str | None = None
+  mtime: float = 0.0
+  version: str | None = None
+  ids: list[str] = field(default_factory=list)
+  payloads: list[dict] = field(default_factory=list)
+  positions: dict[str, int] = field(default_factory=dict)
+  vectors: np.ndarray = field(default_factory=lambda: np.zeros((0, 0), dtype=np.float32))
+  masks: np.ndarray = field(default_factory=lambda: np.zeros((len(intents), 0), dtype=bool))
+  centroids: np.ndarray | None = None
+
+  def records(self, ids: list[str]) -> dict[str, dict]:
+    return {id: self.payloads[self.positions[id]] for id in ids if id in self.positions}
+
+class NumpyRetriever(Retriever):
+  """Exact dense search in a flat matrix of normalized embeddings, exported with `index.py --flat`.
+
+  The matrix is memory-mapped read-only, so that the processes serving the apps share the
+  same pages, and a batch of queries is scored with a single matrix product. The intent
+  filter is applied with the boolean mask of each intent, computed at export time.
+  The export of the live build is followed, and reloaded when it changes.
+  """
+  def __init__(self, path: str | None = None):
+    self.path = path
+    self.lock = threading.Lock()
+    self.index = FlatIndex()
+    self.missing: str | None = None
+
+  def load(self) -> FlatIndex:
+    """Map the export of the live build, again only when another build went live or it was modified.
+
+    Returns the snapshot of the export, to use for a whole search while the next one is loaded.
+    """
+    path = self.path or flat_index_dir()
+    index_file = f"{path}/index.json"
+    if not os.path.exists(index_file):
+      with self.lock:
+        if self.index.path is None:
+          raise FileNotFoundError(f"No flat index in {path}, build it with: uv run index.py --flat")
+        # A build went live without its export, keep searching the previous one
+        if self.missing != path:
+          self.missing = path
+          print(f"⚠️ No flat index in {path}, searching the one in {self.index.path}, export it with: uv run index.py --flat")
+        return self.index
+    mtime = os.path.getmtime(index_file)
+    with self.lock:
+      if path == self.index.path and mtime == self.index.mtime:
+        return self.index
+      with open(index_file) as f:
+        exported = json.load(f)
+      self.index = index = FlatIndex(
+        path=path,
+        mtime=mtime,
+        version=exported["version"],
+        ids=exported["ids"],
+        payloads=exported["payloads"],
+        positions={id: i for i, id in enumerate(exported["ids"])},
+        vectors=np.load(f"{path}/vectors.npy", mmap_mode="r"),
+        masks=np.load(f"{path}/masks.npy"),
+      )
+    if index.version != manifest_info().get("version"):
+      print(f"⚠️ The flat index in {path} is outdated, export it again with: uv run index.py --flat")
+    return index
+
+  def search_batch(
+    self,
+    queries: list[tuple[str, str | None]],
+    limit: int = 10,
+    hybrid: bool = False,
+    embeddings: list[np.ndarray] | None = None,
+  ) -> list[list]:
+    if hybrid:
+      raise ValueError("The numpy retriever only supports the dense search, use the qdrant retriever for hybrid search")
+    unknown = {intent for _, intent in queries if intent and intent not in intents}
+    if unknown:
+      raise ValueError(f"Unknown intents: {', '.join(sorted(unknown))}")
+    index = self.load()
+    if embeddings is None:
+      embeddings = embed_questions([question for question, _ in queries])
+    embeddings = np.stack(embeddings).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    results: list[list] = []
+    with span("numpy_search", queries=len(queries), documents=len(index.ids)):
+      # (documents, queries) cosine similarities
+      scores = index.vectors @ embeddings.T
+      for i, (_, intent) in enumerate(queries):
+        query_scores = scores[:, i]
+        if intent:
+          query_scores = np.where(index.masks[intents.index(intent)], query_scores, -np.inf)
+        k = min(limit * self.overfetch, len(query_scores))
+        if k == 0:
+          results.append([])
+          continue
+        top = np.argpartition(-query_scores, k - 1)[:k]
+        top = top[np.argsort(-query_scores[top])]
+        results.append([
+          Hit(index.ids[j], float(query_scores[j]), index.payloads[j]) for j in top if np.isfinite(query_scores[j])
+        ])
+    return self.collapse(results, limit, index.records)
+
+  def intent_centroids(self) -> np.ndarray:
+    index = self.load()
+    if index.centroids is None:
+      sums = index.masks.astype(np.float32) @ index.vectors
+      index.centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return index.centroids
+
+  def records(self, ids: list[str]) -> dict[str, dict]:
+    return self.load().records(ids)
+
+  def warm(self) -> None:
+    self.load()
+
+retrievers = {"qdrant": QdrantRetriever, "numpy": NumpyRetriever}
+_retrievers: dict[str, Retriever] = {}
+_retrievers_lock = threading.Lock()
+
+def get_retriever(name: str | None = None) -> Retriever:
+  """Retriever shared in the process, `qdrant` or `numpy`, by default from the RETRIEVER variable."""
+  name = name or os.environ.get("RETRIEVER", "qdrant")
+  if name not in retrievers:
+    raise ValueError(f"Unknown retriever: {name}")
+  with _retrievers_lock:
+    if name not in _retrievers:
+      _retrievers[name] = retrievers[name]()
+  return _retrievers[name]
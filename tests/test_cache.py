@@ -0,0 +1,40 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+from cache import LRUCache
+
+# Values stored by the apps: dense embeddings, BM25 vectors and extracted questions
+VALUES = {
+  "dense": np.arange(384, dtype=np.float32) / 384,
+  "sparse": {"indices": [3, 17, 4096], "values": [0.5, 1.25, 2.0]},
+  "extracted": {"intent": "sparql_query", "reformulated": "HGNC symbol of the protein P68871"},
+}
+
+def assert_same(value, expected):
+  if isinstance(expected, np.ndarray):
+    assert value.dtype == expected.dtype and np.array_equal(value, expected)
+  else:
+    assert value == expected
+
+@pytest.mark.parametrize("name", VALUES)
+def test_sqlite_round_trip(tmp_path, name):
+  path = str(tmp_path / "cache.sqlite")
+  LRUCache(path=path).put(name, VALUES[name])
+  # A new cache reads the value back from the database
+  cache = LRUCache(path=path)
+  assert_same(cache.get(name), VALUES[name])
+  assert cache.stats()["disk_hits"] == 1
+
+def test_disk_hit_without_memory_tier(tmp_path):
+  cache = LRUCache(maxsize=0, path=str(tmp_path / "cache.sqlite"))
+  cache.put("dense", VALUES["dense"])
+  assert_same(cache.get("dense"), VALUES["dense"])
+  assert cache.stats()["size"] == 0
+
+def test_disk_tier_keeps_the_entries_accessed_last(tmp_path):
+  cache = LRUCache(maxsize=0, path=str(tmp_path / "cache.sqlite"), disk_maxsize=2)
+  cache.put("a", 1)
+  cache.put("b", 2)
+  cache.get("a")
+  cache.put("c", 3)
+  assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
@@ -0,0 +1,130 @@
+import os
+import sys
+import json
+import time
+import textwrap
+import threading
+import subprocess
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+pytest.importorskip("langchain_core")
+pytest.importorskip("numpy")
+
+repo = Path(__file__).resolve().parent.parent
+
+class StandInSparqlHandler(BaseHTTPRequestHandler):
+  """Stand-in SPARQL endpoint: /hang never answers, /sparql answers an example query."""
+  def do_GET(self):
+    if self.path.startswith("/hang"):
+      time.sleep(3600)
+      return
+    body = json.dumps({"results": {"bindings": [{"query": {"value": "SELECT * WHERE { ?s ?p ?o }"}}]}}).encode()
+    self.send_response(200)
+    self.send_header("Content-Type", "application/sparql-results+json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+@pytest.fixture
+def sparql_server():
+  server = ThreadingHTTPServer(("127.0.0.1", 0), StandInSparqlHandler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield f"http://127.0.0.1:{server.server_port}"
+  server.shutdown()
+  server.server_close()
+
+# Harvest a hung and a working endpoint in a separate process, whose exit is what is tested
+HARVEST = textwrap.dedent("""
+  import sys
+  import json
+  import urllib.request
+  from langchain_core.documents import Document
+  import index
+
+  class StandInLoader:
+    def __init__(self, endpoint):
+      self.endpoint = endpoint
+
+    def load(self):
+      with urllib.request.urlopen(self.endpoint) as resp:
+        bindings = json.load(resp)["results"]["bindings"]
+      return [Document(page_content=b["query"]["value"], metadata={"endpoint_url": self.endpoint}) for b in bindings]
+
+  docs, failed = index.load_sparql_endpoints(timeout=1, endpoints=sys.argv[1:], loaders=(StandInLoader,))
+  print(json.dumps({"docs": len(docs), "failed": failed}))
+""")
+
+def test_hung_endpoint_is_skipped_and_process_exits(sparql_server, tmp_path):
+  start = time.perf_counter()
+  proc = subprocess.run(
+    [sys.executable, "-c", HARVEST, f"{sparql_server}/hang", f"{sparql_server}/sparql"],
+    cwd=repo,
+    env={**os.environ, "HTTP_CACHE_DIR": str(tmp_path)},
+    capture_output=True,
+    text=True,
+    timeout=60,
+  )
+  assert proc.returncode == 0, proc.stderr
+  result = json.loads(proc.stdout.strip().splitlines()[-1])
+  assert result == {"docs": 1, "failed": [f"StandInLoader {sparql_server}/hang"]}
+  # The hung loader thread is abandoned after its timeout instead of being joined at exit
+  assert time.perf_counter() - start < 30
+
+## cache of the harvested documents
+class CountingLoader:
+  """Loader returning one document per call, or failing when `fail` is set."""
+  calls = 0
+  fail = False
+
+  def __init__(self, endpoint):
+    self.endpoint = endpoint
+
+  def load(self):
+    from langchain_core.documents import Document
+    CountingLoader.calls += 1
+    if CountingLoader.fail:
+      raise ConnectionError(f"{self.endpoint} is down")
+    return [Document(page_content=f"harvest {CountingLoader.calls}", metadata={"endpoint_url": self.endpoint})]
+
+@pytest.fixture
+def harvest(tmp_path, monkeypatch):
+  import asyncio
+  import httpcache
+  import index
+  monkeypatch.setattr(httpcache, "cache_dir", str(tmp_path))
+  monkeypatch.setattr(httpcache, "offline", False)
+  monkeypatch.setattr(CountingLoader, "calls", 0)
+  monkeypatch.setattr(CountingLoader, "fail", False)
+
+  def run(max_age: float = 0):
+    async def harvest_one():
+      return await index.harvest("http://endpoint.test/sparql", CountingLoader, asyncio.Semaphore(1), 5, max_age)
+    return asyncio.run(harvest_one())
+  return run
+
+def test_fresh_documents_are_reused(harvest):
+  first = harvest(max_age=3600)
+  assert [doc.page_content for doc in harvest(max_age=3600)] == [doc.page_content for doc in first]
+  assert CountingLoader.calls == 1
+  assert harvest(max_age=0)[0].page_content == "harvest 2"
+
+def test_failed_endpoint_falls_back_on_last_harvest(harvest):
+  harvest()
+  CountingLoader.fail = True
+  assert harvest()[0].page_content == "harvest 1"
+
+def test_offline_uses_the_cache_whatever_its_age(harvest, monkeypatch):
+  import httpcache
+  monkeypatch.setattr(httpcache, "offline", True)
+  assert harvest() is None
+  monkeypatch.setattr(httpcache, "offline", False)
+  harvest()
+  monkeypatch.setattr(httpcache, "offline", True)
+  assert harvest(max_age=0)[0].page_content == "harvest 1"
+  assert CountingLoader.calls == 1
@@ -0,0 +1,89 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+pytest.importorskip("httpx")
+import httpcache
+
+class FileServer:
+  """Local server of a single file with an ETag, counting the full and not modified responses."""
+  def __init__(self):
+    self.content = b"title,url\nUniProt,https://www.uniprot.org\n"
+    self.etag = '"v1"'
+    self.sent = 0
+    self.not_modified = 0
+    files = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.headers.get("If-None-Match") == files.etag:
+          files.not_modified += 1
+          self.send_response(304)
+          self.send_header("ETag", files.etag)
+          self.end_headers()
+          return
+        files.sent += 1
+        self.send_response(200)
+        self.send_header("ETag", files.etag)
+        self.send_header("Content-Length", str(len(files.content)))
+        self.end_headers()
+        self.wfile.write(files.content)
+
+      def log_message(self, *args):
+        pass
+
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    self.url = f"http://127.0.0.1:{self.server.server_port}/resources.csv"
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+  monkeypatch.setattr(httpcache, "cache_dir", str(tmp_path))
+  monkeypatch.setattr(httpcache, "offline", False)
+  server = FileServer()
+  yield server
+  server.stop()
+
+def test_download_then_not_modified(files):
+  assert httpcache.fetch(files.url) == files.content
+  assert httpcache.fetch(files.url) == files.content
+  assert (files.sent, files.not_modified) == (1, 1)
+
+def test_changed_file_is_downloaded_again(files):
+  httpcache.fetch(files.url)
+  files.content, files.etag = b"title,url\nBgee,https://www.bgee.org\n", '"v2"'
+  assert httpcache.fetch(files.url) == files.content
+  assert (files.sent, files.not_modified) == (2, 0)
+
+def test_last_copy_when_the_server_is_unreachable(files):
+  content = httpcache.fetch(files.url)
+  files.stop()
+  assert httpcache.fetch(files.url) == content
+
+def test_error_when_nothing_cached_and_unreachable(files):
+  files.stop()
+  with pytest.raises(httpcache.httpx.HTTPError):
+    httpcache.fetch(files.url)
+
+def test_offline_serves_the_cache_without_request(files, monkeypatch):
+  content = httpcache.fetch(files.url)
+  monkeypatch.setattr(httpcache, "offline", True)
+  assert httpcache.fetch(files.url) == content
+  assert (files.sent, files.not_modified) == (1, 0)
+  with pytest.raises(FileNotFoundError):
+    httpcache.fetch(f"{files.url}?uncached")
+
+def test_concurrent_writers_do_not_share_a_temporary_file(tmp_path):
+  path = f"{tmp_path}/entry"
+  writers = [threading.Thread(target=httpcache.write_atomic, args=(path, bytes([i]) * 100_000)) for i in range(8)]
+  for writer in writers:
+    writer.start()
+  for writer in writers:
+    writer.join()
+  with open(path, "rb") as f:
+    content = f.read()
+  assert len(content) == 100_000 and len(set(content)) == 1
@@ -0,0 +1,259 @@
+import os
+import sys
+import atexit
+import json
+import time
+import uuid
+import threading
+import functools
+import contextvars
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+
+## spans around the stages of the RAG pipeline, sent to the sinks listed in TRACING
+# e.g. TRACING=json,prometheus (json, otel and prometheus are available)
+
+class Span:
+  """A timed stage of the pipeline, with its attributes and its parent span."""
+  def __init__(self, name: str, parent: "Span | None", attributes: dict):
+    self.name = name
+    self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+    self.span_id = uuid.uuid4().hex[:16]
+    self.parent_id = parent.span_id if parent else None
+    self.attributes = attributes
+    self.start = time.time()
+    self.started = time.perf_counter()
+    self.duration: float | None = None
+    self.error: str | None = None
+    self.first_token: float | None = None
+    self.chunks = 0
+
+  def set(self, **attributes) -> None:
+    self.attributes.update(attributes)
+
+  def token(self) -> None:
+    """Record a streamed chunk of the LLM answer, the first one sets the time to first token."""
+    if self.first_token is None:
+      self.first_token = time.perf_counter() - self.started
+      self.attributes["first_token_s"] = round(self.first_token, 4)
+    self.chunks += 1
+
+  def finish(self) -> None:
+    self.duration = time.perf_counter() - self.started
+    if self.first_token is not None:
+      self.attributes["chunks"] = self.chunks
+      tokens = self.attributes.get("output_tokens", self.chunks)
+      streaming = self.duration - self.first_token
+      if streaming > 0:
+        self.attributes["tokens_per_s"] = round(tokens / streaming, 1)
+
+  def to_dict(self) -> dict:
+    return {
+      "name": self.name,
+      "trace_id": self.trace_id,
+      "span_id": self.span_id,
+      "parent_id": self.parent_id,
+      "start": self.start,
+      "duration_s": round(self.duration or 0.0, 6),
+      "error": self.error,
+      "attributes": self.attributes,
+    }
+
+class JsonSink:
+  """Write each finished span as a JSON line, to TRACING_JSON_PATH or stderr."""
+  def __init__(self, path: str | None = None):
+    self.file = open(path, "a") if path else sys.stderr
+    self.lock = threading.Lock()
+    if path:
+      atexit.register(self.close)
+
+  def close(self) -> None:
+    with self.lock:
+      if not self.file.closed:
+        self.file.close()
+
+  def start(self, span: Span) -> None:
+    pass
+
+  def end(self, span: Span) -> None:
+    line = json.dumps(span.to_dict(), default=str)
+    with self.lock:
+      if not self.file.closed:
+        self.file.write(line + "\n")
+        self.file.flush()
+
+class OtelSink:
+  """Mirror the spans with OpenTelemetry, exported by the configured tracer provider.
+
+  Without one, the spans are exported with OTLP when `opentelemetry-exporter-otlp` is installed
+  (see the OTEL_EXPORTER_OTLP_* variables), or printed to the console otherwise.
+  """
+  def __init__(self):
+    from opentelemetry import trace
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    if not isinstance(trace.get_tracer_provider(), TracerProvider):
+      try:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()
+      except ImportError:
+        exporter = ConsoleSpanExporter()
+      provider = TracerProvider()
+      provider.add_span_processor(BatchSpanProcessor(exporter))
+      trace.set_tracer_provider(provider)
+    self.trace = trace
+    self.tracer = trace.get_tracer("llm-sib")
+    self.spans: dict[str, object] = {}
+    self.lock = threading.Lock()
+
+  def start(self, span: Span) -> None:
+    with self.lock:
+      parent = self.spans.get(span.parent_id)
+    context = self.trace.set_span_in_context(parent) if parent else None
+    otel_span = self.tracer.start_span(span.name, context=context, start_time=int(span.start * 1e9))
+    with self.lock:
+      self.spans[span.span_id] = otel_span
+
+  def end(self, span: Span) -> None:
+    with self.lock:
+      otel_span = self.spans.pop(span.span_id, None)
+    if otel_span is None:
+      return
+    for key, value in span.attributes.items():
+      otel_span.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+    if span.error:
+      otel_span.set_status(self.trace.Status(self.trace.StatusCode.ERROR, span.error))
+    otel_span.end(end_time=int((span.start + span.duration) * 1e9))
+
+class PrometheusSink:
+  """Histograms of the stage durations and LLM time to first token, and counters of the errors
+  and streamed tokens, rendered in the Prometheus text format by `render`."""
+  buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.histograms: dict[tuple[str, str], tuple[list[int], float]] = {}
+    self.counters: dict[tuple[str, str], float] = {}
+
+  def observe(self, metric: str, stage: str, value: float) -> None:
+    counts, total = self.histograms.get((metric, stage), ([0] * (len(self.buckets) + 1), 0.0))
+    # Cumulative buckets, the last one is +Inf
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        counts[i] += 1
+    counts[-1] += 1
+    self.histograms[(metric, stage)] = (counts, total + value)
+
+  def start(self, span: Span) -> None:
+    pass
+
+  def end(self, span: Span) -> None:
+    with self.lock:
+      self.observe("rag_stage_duration_seconds", span.name, span.duration)
+      if span.first_token is not None:
+        self.observe("rag_llm_first_token_seconds", span.name, span.first_token)
+        key = ("rag_llm_chunks_total", span.name)
+        self.counters[key] = self.counters.get(key, 0) + span.chunks
+      if span.error:
+        key = ("rag_stage_errors_total", span.name)
+        self.counters[key] = self.counters.get(key, 0) + 1
+
+  def render(self) -> str:
+    lines: list[str] = []
+    with self.lock:
+      for metric in sorted({metric for metric, _ in self.histograms}):
+        lines.append(f"# TYPE {metric} histogram")
+        for (name, stage), (counts, total) in sorted(self.histograms.items()):
+          if name != metric:
+            continue
+          for bound, count in zip(self.buckets, counts):
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+          lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {counts[-1]}')
+          lines.append(f'{metric}_sum{{stage="{stage}"}} {total}')
+          lines.append(f'{metric}_count{{stage="{stage}"}} {counts[-1]}')
+      for metric in sorted({metric for metric, _ in self.counters}):
+        lines.append(f"# TYPE {metric} counter")
+        for (name, stage), value in sorted(self.counters.items()):
+          if name == metric:
+            lines.append(f'{metric}{{stage="{stage}"}} {value}')
+    gauges: dict[str, list[str]] = {}
+    for collector in collectors:
+      for metric, labels, value in collector():
+        rendered = ",".join(f'{key}="{label}"' for key, label in labels.items())
+        gauges.setdefault(metric, []).append(f"{metric}{{{rendered}}} {value}")
+    for metric, samples in sorted(gauges.items()):
+      lines.append(f"# TYPE {metric} gauge")
+      lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+sink_types: dict[str, Callable[[], object]] = {
+  "json": lambda: JsonSink(os.environ.get("TRACING_JSON_PATH")),
+  "otel": OtelSink,
+  "prometheus": PrometheusSink,
+}
+# Packages of the optional sinks, installed with e.g. `uv sync --extra otel`
+sink_packages = {"otel": "opentelemetry-sdk (uv sync --extra otel)"}
+
+def make_sink(name: str):
+  """Sink of the name, or None with a warning when its optional packages are not installed."""
+  if name not in sink_types:
+    raise ValueError(f"Unknown tracing sink: {name}")
+  try:
+    return sink_types[name]()
+  except ImportError as e:
+    print(f"⚠️ The {name} tracing sink is disabled, it requires {sink_packages.get(name, e.name)}: {e}", file=sys.stderr)
+    return None
+
+sinks: list = [
+  sink for sink in (make_sink(name.strip()) for name in os.environ.get("TRACING", "").split(",") if name.strip())
+  if sink is not None
+]
+_current: contextvars.ContextVar[Span | None] = contextvars.ContextVar("span", default=None)
+
+# Gauges read when the metrics are rendered, e.g. the state of the rate limiters and caches
+collectors: list[Callable[[], list[tuple[str, dict[str, str], float]]]] = []
+
+def add_collector(collector: Callable[[], list[tuple[str, dict[str, str], float]]]) -> None:
+  """Render the (metric, labels, value) gauges returned by the collector with the metrics of the PrometheusSink."""
+  collectors.append(collector)
+
+def add_sink(sink) -> None:
+  """Send the next spans to another sink, with `start(span)` and `end(span)` methods."""
+  sinks.append(sink)
+
+def get_sink(sink_type: type):
+  """First configured sink of the type, e.g. the PrometheusSink to serve its metrics."""
+  return next((sink for sink in sinks if isinstance(sink, sink_type)), None)
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+  """Time the block as a span, child of the current span of the context."""
+  current = Span(name, _current.get(), attributes)
+  token = _current.set(current)
+  for sink in sinks:
+    sink.start(current)
+  try:
+    yield current
+  except BaseException as e:
+    current.error = repr(e)
+    raise
+  finally:
+    _current.reset(token)
+    current.finish()
+    for sink in sinks:
+      sink.end(current)
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+  """Decorator opening a span around each call of a function."""
+  def decorator(func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with span(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def in_context(func: Callable, *args) -> Callable[[], object]:
+  """Bind a call to the current context, so that the spans it opens in a worker thread keep their parent."""
+  context = contextvars.copy_context()
+  return lambda: context.run(func, *args)